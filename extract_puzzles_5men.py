@@ -4,20 +4,33 @@
 from __future__ import annotations
 
 import argparse
+import array
 import csv
 import math
+import os
 import time
+from collections import Counter
 from dataclasses import dataclass
+from itertools import accumulate
 from pathlib import Path
-from typing import Dict, Iterable, Optional, TextIO, Tuple
+from typing import Dict, Iterable, Optional, Tuple
 
 import chess
 
 
 PIECE_ORDER = "KQRBNP"
+_PIECE_LETTERS = frozenset(PIECE_ORDER)
 MIN_RATING = 1000
 MAX_PLIES = 6  # 3 full moves = 6 plies
 
+# Per-material output is accumulated as bytes and written with one os.write() per flush.
+OUT_FLUSH_BYTES = 1 << 20
+
+# Histogram layout for OnlineAgg (fixed-size counters indexed by bin).
+RATING_HIST_BINS = 100  # rating // 50, ratings below 5000
+POP_HIST_OFFSET = 10  # popularity is in [-100, 100] -> pop // 10 in [-10, 10]
+POP_HIST_BINS = 21
+
 
 @dataclass(frozen=True)
 class Material:
@@ -67,12 +80,12 @@ class OnlineAgg:
     min_pop: int = 10**9
     max_pop: int = -10**9
 
-    rating_hist: Optional[Dict[int, int]] = None
-    pop_hist: Optional[Dict[int, int]] = None
+    rating_hist: Optional[array.array] = None
+    pop_hist: Optional[array.array] = None
 
     def __post_init__(self) -> None:
-        self.rating_hist = self.rating_hist or {}
-        self.pop_hist = self.pop_hist or {}
+        self.rating_hist = self.rating_hist or array.array("I", [0]) * RATING_HIST_BINS
+        self.pop_hist = self.pop_hist or array.array("I", [0]) * POP_HIST_BINS
 
     def add(self, rating: int, pop: int) -> None:
         self.count += 1
@@ -83,8 +96,9 @@ class OnlineAgg:
         self.min_pop = min(self.min_pop, pop)
         self.max_pop = max(self.max_pop, pop)
 
-        self.rating_hist[rating // 50] = self.rating_hist.get(rating // 50, 0) + 1
-        self.pop_hist[pop // 10] = self.pop_hist.get(pop // 10, 0) + 1
+        # Out-of-range values go to the edge bins (min/max/avg still see the exact value).
+        self.rating_hist[min(max(rating // 50, 0), RATING_HIST_BINS - 1)] += 1
+        self.pop_hist[min(max(pop // 10 + POP_HIST_OFFSET, 0), POP_HIST_BINS - 1)] += 1
 
     def avg_rating(self) -> float:
         return self.sum_rating / self.count if self.count else 0.0
@@ -92,16 +106,14 @@ class OnlineAgg:
     def avg_pop(self) -> float:
         return self.sum_pop / self.count if self.count else 0.0
 
-    def _hist_percentile(self, hist: Dict[int, int], p: float) -> int:
-        if not hist or self.count == 0:
+    def _hist_percentile(self, hist: array.array, p: float, offset: int = 0) -> int:
+        if self.count == 0:
             return 0
         target = max(1, int(math.ceil(p * self.count)))
-        cum = 0
-        for b in sorted(hist.keys()):
-            cum += hist[b]
+        for b, cum in enumerate(accumulate(hist)):
             if cum >= target:
-                return b
-        return max(hist.keys())
+                return b - offset
+        return len(hist) - 1 - offset
 
     def rating_p50(self) -> int:
         return self._hist_percentile(self.rating_hist, 0.50) * 50
@@ -110,10 +122,10 @@ class OnlineAgg:
         return self._hist_percentile(self.rating_hist, 0.90) * 50
 
     def pop_p50(self) -> int:
-        return self._hist_percentile(self.pop_hist, 0.50) * 10
+        return self._hist_percentile(self.pop_hist, 0.50, POP_HIST_OFFSET) * 10
 
     def pop_p90(self) -> int:
-        return self._hist_percentile(self.pop_hist, 0.90) * 10
+        return self._hist_percentile(self.pop_hist, 0.90, POP_HIST_OFFSET) * 10
 
 
 def fmt_elapsed(seconds: float) -> str:
@@ -126,35 +138,35 @@ def fmt_elapsed(seconds: float) -> str:
 
 def canonicalize_material(s: str) -> str:
     s = s.strip().upper()
-    for c in s:
-        if c not in PIECE_ORDER:
-            raise ValueError(f"Invalid piece letter: {c!r}. Allowed: KQRBNP.")
-    counts = {p: s.count(p) for p in PIECE_ORDER}
+    if not _PIECE_LETTERS.issuperset(s):
+        c = next(c for c in s if c not in _PIECE_LETTERS)
+        raise ValueError(f"Invalid piece letter: {c!r}. Allowed: KQRBNP.")
+    counts = Counter(s)
     return "".join(p * counts[p] for p in PIECE_ORDER)
 
 
 def material_from_board(board: chess.Board) -> Material:
-    w_counts = {p: 0 for p in PIECE_ORDER}
-    b_counts = {p: 0 for p in PIECE_ORDER}
-
-    for pt, letter in [
-        (chess.KING, "K"),
-        (chess.QUEEN, "Q"),
-        (chess.ROOK, "R"),
-        (chess.BISHOP, "B"),
-        (chess.KNIGHT, "N"),
-        (chess.PAWN, "P"),
-    ]:
-        w_counts[letter] = len(board.pieces(pt, chess.WHITE))
-        b_counts[letter] = len(board.pieces(pt, chess.BLACK))
-
-    w = "".join(p * w_counts[p] for p in PIECE_ORDER)
-    b = "".join(p * b_counts[p] for p in PIECE_ORDER)
-    return Material(white=canonicalize_material(w), black=canonicalize_material(b))
-
-
-def piece_count_from_fen_placement(fen: str) -> int:
-    placement = fen.split(" ", 1)[0]
+    """
+    Material read straight from the piece bitboards (popcounts), already in KQRBNP order.
+    """
+    popcount = chess.popcount
+    sides = []
+    for occ in (board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK]):
+        sides.append(
+            "K" * popcount(board.kings & occ)
+            + "Q" * popcount(board.queens & occ)
+            + "R" * popcount(board.rooks & occ)
+            + "B" * popcount(board.bishops & occ)
+            + "N" * popcount(board.knights & occ)
+            + "P" * popcount(board.pawns & occ)
+        )
+    return Material(white=sides[0], black=sides[1])
+
+
+def piece_count_from_fen_placement(placement: str) -> int:
+    """
+    Number of pieces in the FEN placement field (the caller extracts the field).
+    """
     return sum(1 for ch in placement if ch.isalpha())
 
 
@@ -162,6 +174,10 @@ def square_rot180(sq: int) -> int:
     return 63 - sq
 
 
+# Square name -> name of the 180-degree rotated square (e.g. "a1" -> "h8").
+_ROT180_NAME = {chess.square_name(sq): chess.square_name(square_rot180(sq)) for sq in range(64)}
+
+
 def rotate_uci_180(uci: str) -> str:
     """
     Rotate an UCI move 180 degrees (a1<->h8) by mapping from/to squares.
@@ -169,12 +185,7 @@ def rotate_uci_180(uci: str) -> str:
     """
     if len(uci) < 4:
         return uci
-    a = chess.parse_square(uci[0:2])
-    b = chess.parse_square(uci[2:4])
-    a2 = square_rot180(a)
-    b2 = square_rot180(b)
-    promo = uci[4:] if len(uci) > 4 else ""
-    return chess.square_name(a2) + chess.square_name(b2) + promo
+    return _ROT180_NAME[uci[0:2]] + _ROT180_NAME[uci[2:4]] + uci[4:]
 
 
 def invert_position_if_black_to_move(board: chess.Board) -> chess.Board:
@@ -206,14 +217,35 @@ def invert_position_if_black_to_move(board: chess.Board) -> chess.Board:
     return b2
 
 
+def copy_board_into(dst: chess.Board, src: chess.Board) -> None:
+    """
+    Overwrite `dst` with the position of `src` (same fields as Board.copy(stack=False)).
+    Used to reuse one scratch board instead of allocating a copy per row.
+    """
+    dst.pawns = src.pawns
+    dst.knights = src.knights
+    dst.bishops = src.bishops
+    dst.rooks = src.rooks
+    dst.queens = src.queens
+    dst.kings = src.kings
+    dst.occupied_co[chess.WHITE] = src.occupied_co[chess.WHITE]
+    dst.occupied_co[chess.BLACK] = src.occupied_co[chess.BLACK]
+    dst.occupied = src.occupied
+    dst.promoted = src.promoted
+    dst.chess960 = src.chess960
+    dst.ep_square = src.ep_square
+    dst.castling_rights = src.castling_rights
+    dst.turn = src.turn
+    dst.fullmove_number = src.fullmove_number
+    dst.halfmove_clock = src.halfmove_clock
+    dst.clear_stack()
+
+
 def black_has_only_king(board: chess.Board) -> bool:
     """
     True iff Black has no pieces other than the King.
     """
-    for pt in (chess.QUEEN, chess.ROOK, chess.BISHOP, chess.KNIGHT, chess.PAWN):
-        if board.pieces(pt, chess.BLACK):
-            return False
-    return True
+    return not (board.occupied_co[chess.BLACK] & ~board.kings)
 
 
 def stable_fen_for_output(board: chess.Board) -> str:
@@ -252,22 +284,49 @@ def zstd_csv_rows(zst_path: Path) -> Iterable[Dict[str, str]]:
             raise RuntimeError(f"zstd exited with code {proc.returncode}")
 
 
-def get_handle(handles: Dict[Path, TextIO], path: Path) -> TextIO:
-    h = handles.get(path)
-    if h is not None:
-        return h
+def get_out_buffer(fds: Dict[Path, int], bufs: Dict[Path, bytearray], path: Path) -> bytearray:
+    """
+    Return the pending-output buffer for `path`, opening its raw append-mode fd on first use.
+    """
+    buf = bufs.get(path)
+    if buf is not None:
+        return buf
     path.parent.mkdir(parents=True, exist_ok=True)
-    h = path.open("a", encoding="utf-8")
-    handles[path] = h
-    return h
+    fds[path] = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    buf = bytearray()
+    bufs[path] = buf
+    return buf
+
+
+def flush_out_buffer(fd: int, buf: bytearray) -> None:
+    view = memoryview(buf)
+    while view:
+        view = view[os.write(fd, view):]
+    view.release()
+    buf.clear()
 
 
-def close_handles(handles: Dict[Path, TextIO]) -> None:
-    for h in handles.values():
+def close_out_buffers(fds: Dict[Path, int], bufs: Dict[Path, bytearray], flush: bool = True) -> None:
+    """
+    Flush (unless `flush` is False) and close every fd. An error on one fd does not stop
+    the others from being flushed and closed; the first error is re-raised at the end.
+    """
+    first_err: Optional[OSError] = None
+    for path, fd in fds.items():
         try:
-            h.close()
-        except Exception:
-            pass
+            if flush:
+                flush_out_buffer(fd, bufs[path])
+        except OSError as e:
+            if first_err is None:
+                first_err = e
+        finally:
+            try:
+                os.close(fd)
+            except OSError as e:
+                if first_err is None:
+                    first_err = e
+    if first_err is not None:
+        raise first_err
 
 
 def write_stats_by_material(path: Path, by_mat: Dict[str, OnlineAgg]) -> None:
@@ -307,16 +366,23 @@ def main() -> None:
     out_dir: Path = args.out_dir
     max_pieces: int = args.max_pieces
     min_rating: int = args.min_rating
+    fast_piece_limit = max_pieces + 2
 
     required = {"PuzzleId", "FEN", "Moves", "Rating", "Popularity"}
 
     t0 = time.time()
     stats = Stats()
-    handles: Dict[Path, TextIO] = {}
+    out_fds: Dict[Path, int] = {}
+    out_bufs: Dict[Path, bytearray] = {}
 
     by_mat: Dict[str, OnlineAgg] = {}
     global_agg = OnlineAgg()
 
+    # Scratch boards reused across rows (set_fen / copy_board_into overwrite them in place).
+    scratch = chess.Board.empty()
+    scratch_tmp = chess.Board.empty()
+
+    write_failed = False
     try:
         for row in zstd_csv_rows(zst_path):
             stats.scanned += 1
@@ -351,28 +417,33 @@ def main() -> None:
 
             fen0 = row["FEN"]
 
+            # FEN field boundaries, located without splitting the whole string.
+            sp1 = fen0.find(" ")
+            sp2 = fen0.find(" ", sp1 + 1)
+            sp3 = fen0.find(" ", sp2 + 1)
+
             # Fast piece-count prefilter on the *pre-blunder* position.
             # After one move, piece count can only drop by at most 1 (capture).
-            n0 = piece_count_from_fen_placement(fen0)
-            if n0 >= max_pieces + 2:
+            n0 = piece_count_from_fen_placement(fen0[:sp1] if sp1 >= 0 else fen0)
+            if n0 >= fast_piece_limit:
                 stats.excluded_piece_count_fast += 1
                 continue
 
             # Fast castling rights prefilter (string-level).
-            parts0 = fen0.split()
-            if len(parts0) < 4:
+            if sp2 < 0 or sp3 < 0:
                 stats.excluded_invalid_fen += 1
                 continue
-            if parts0[2] != "-":
+            if fen0[sp2 + 1 : sp3] != "-":
                 stats.excluded_castling_rights += 1
                 continue
 
             # Parse the position and apply the blunder move0.
             try:
-                b = chess.Board(fen0)
+                scratch.set_fen(fen0)
             except Exception:
                 stats.excluded_invalid_fen += 1
                 continue
+            b = scratch
 
             try:
                 mv0 = chess.Move.from_uci(moves[0])
@@ -390,7 +461,7 @@ def main() -> None:
                 continue
 
             # Post-blunder piece-count filter (exact).
-            if len(b.piece_map()) > max_pieces:
+            if chess.popcount(b.occupied) > max_pieces:
                 stats.excluded_piece_count_post += 1
                 continue
 
@@ -414,7 +485,7 @@ def main() -> None:
                 inverted = True
                 stats.inverted += 1
             else:
-                b2 = b.copy(stack=False)
+                b2 = b
 
             # Apply the "trivial-fast" filter only if we have >= 6 plies available after move0.
             # That means we need at least moves[1]..moves[6].
@@ -424,10 +495,13 @@ def main() -> None:
                 if inverted:
                     seq = [rotate_uci_180(m) for m in seq]
 
-                tmp = b2.copy(stack=False)
+                tmp = scratch_tmp
+                copy_board_into(tmp, b2)
 
                 # Check condition at start (0 plies), within <=3 moves.
-                mate_or_lone = tmp.is_checkmate() or black_has_only_king(tmp)
+                # Cheapest test first: lone king is one bitboard AND, mate needs a check test
+                # (and legal move generation only when in check).
+                mate_or_lone = black_has_only_king(tmp) or tmp.is_checkmate()
 
                 if not mate_or_lone:
                     for u in seq:
@@ -445,13 +519,13 @@ def main() -> None:
 
                         tmp.push(mv)
 
-                        # If mate occurs within <= 6 plies -> exclude.
-                        if tmp.is_checkmate():
+                        # If Black is reduced to lone king within <= 6 plies -> exclude.
+                        if black_has_only_king(tmp):
                             mate_or_lone = True
                             break
 
-                        # If Black is reduced to lone king within <= 6 plies -> exclude.
-                        if black_has_only_king(tmp):
+                        # If mate occurs within <= 6 plies -> exclude.
+                        if tmp.is_checkmate():
                             mate_or_lone = True
                             break
 
@@ -467,21 +541,21 @@ def main() -> None:
 
             # Finalize output position:
             # - Always white to move by construction.
-            # - Remove castling and EP (TE-friendly).
-            out_board = b2.copy(stack=False)
-            out_board.turn = chess.WHITE
-            out_board.castling_rights = 0
-            out_board.ep_square = None
-            out_board.halfmove_clock = 0
-            out_board.fullmove_number = 1
-
-            mat = material_from_board(out_board)
-            fen_out = stable_fen_for_output(out_board)
+            # - Castling/EP/clocks are dropped by stable_fen_for_output (TE-friendly),
+            #   so b2 is used as-is: only its piece placement is read.
+            mat = material_from_board(b2)
+            fen_out = stable_fen_for_output(b2)
 
             out_path = out_dir / mat.filename
-            h = get_handle(handles, out_path)
+            buf = get_out_buffer(out_fds, out_bufs, out_path)
             # Added outcome 'W' to the record (puzzles are wins)
-            h.write(f"{row['PuzzleId']}\t{rating_s}\t{pop_s}\t{fen_out}\tW\n")
+            buf += f"{row['PuzzleId']}\t{rating_s}\t{pop_s}\t{fen_out}\tW\n".encode()
+            if len(buf) >= OUT_FLUSH_BYTES:
+                try:
+                    flush_out_buffer(out_fds[out_path], buf)
+                except OSError:
+                    write_failed = True
+                    raise
 
             agg = by_mat.get(mat.key)
             if agg is None:
@@ -492,8 +566,15 @@ def main() -> None:
 
             stats.kept += 1
 
-    finally:
-        close_handles(handles)
+    except BaseException:
+        # Still write out the kept rows, unless writing is what failed.
+        # A flush or close error must not mask the exception that stopped the loop.
+        try:
+            close_out_buffers(out_fds, out_bufs, flush=not write_failed)
+        except OSError:
+            pass
+        raise
+    close_out_buffers(out_fds, out_bufs)
 
     elapsed = time.time() - t0
     out_dir.mkdir(parents=True, exist_ok=True)
@@ -8,27 +8,41 @@ from typing import Any, Mapping
 import chess
 
 from helpers import mask_files, mask_ranks
-from k_vs_kp import filter_notb_k_vs_kp, filter_tb_k_vs_kp, gen_hints_k_vs_kp
+from k_vs_kp import (
+    filter_notb_k_vs_kp,
+    filter_notb_placement_k_vs_kp,
+    filter_tb_k_vs_kp,
+    gen_hints_k_vs_kp,
+)
 from kbp_vs_kb import (
     filter_notb_kbp_vs_kb,
+    filter_notb_placement_kbp_vs_kb,
     filter_tb_kbp_vs_kb,
     gen_hints_kbp_vs_kb,
 )
-from kp_vs_k import filter_notb_kp_vs_k, filter_tb_kp_vs_k, gen_hints_kp_vs_k
+from kp_vs_k import (
+    filter_notb_kp_vs_k,
+    filter_notb_placement_kp_vs_k,
+    filter_tb_kp_vs_k,
+    gen_hints_kp_vs_k,
+)
 from kp_vs_kp import (
     filter_notb_kp_vs_kp,
+    filter_notb_placement_kp_vs_kp,
     filter_tb_kp_vs_kp,
     gen_hints_kp_vs_kp,
 )
-from kp_vs_kr import filter_notb_kp_vs_kr, filter_tb_kp_vs_kr
-from kr_vs_kp import filter_notb_kr_vs_kp, filter_tb_kr_vs_kp
+from kp_vs_kr import filter_notb_kp_vs_kr, filter_notb_placement_kp_vs_kr, filter_tb_kp_vs_kr
+from kr_vs_kp import filter_notb_kr_vs_kp, filter_notb_placement_kr_vs_kp, filter_tb_kr_vs_kp
 from kr_vs_krp import (
     filter_notb_kr_vs_krp,
+    filter_notb_placement_kr_vs_krp,
     filter_tb_kr_vs_krp,
     gen_hints_kr_vs_krp,
 )
 from krp_vs_kr import (
     filter_notb_krp_vs_kr,
+    filter_notb_placement_krp_vs_kr,
     filter_tb_krp_vs_kr,
     gen_hints_krp_vs_kr,
 )
@@ -45,14 +59,10 @@ def filter_notb_generic(board: chess.Board) -> bool:
     Return True to keep the position for the next stage (TB stage),
     or False to reject early.
     """
-    moves_iter = iter(board.legal_moves)
-    try:
-        next(moves_iter)
-        next(moves_iter)
-    except StopIteration:
-        return False
-
-    return True
+    # Stop generating after the second legal move (no full count, no
+    # is_checkmate()/is_stalemate() pass: those would generate moves again).
+    moves_iter = board.generate_legal_moves()
+    return next(moves_iter, None) is not None and next(moves_iter, None) is not None
 
 
 def filter_tb_generic(board: chess.Board, tb: Mapping[str, Any]) -> bool:
@@ -62,10 +72,16 @@ def filter_tb_generic(board: chess.Board, tb: Mapping[str, Any]) -> bool:
     `tb` contains:
       - "wdl": int in {-1, 0, +1} from White's perspective
       - "dtm": Optional[int] in plies, from White's perspective (None if draw)
-      - "probe_move": function(move) -> dict with:
-          - "uci": str
-          - "wdl": int in {-1, 0, +1} from White's perspective
-          - "dtm": Optional[int] from White's perspective (None if draw)
+      - "probe_move": function(move) -> TBMove named tuple with:
+          - uci: str
+          - wdl: int in {-1, 0, +1} from White's perspective
+          - dtm: Optional[int] from White's perspective (None if draw)
+      - "probe_move_wdl": function(move) -> int, just the child wdl of probe_move(move);
+        use it in loops that never read uci/dtm.
+      - "probe_wdls": function() -> array.array('b'), the child wdl of every legal move
+        (generation order); use it when all moves are probed anyway, e.g. wdls.count(1).
+      - "legal_moves": function() -> list of the legal moves, generated once per position
+        (shared with probe_wdls; do not mutate it).
     """
     return True
 
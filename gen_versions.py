@@ -1,24 +1,35 @@
 import hashlib
 import json
+import os
 import pathlib
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 data_dir = pathlib.Path("data")
 pattern = re.compile(r"^K[A-Z]*_K[A-Z]*\.txt$")
 
-files = {}
-for p in sorted(data_dir.glob("*.txt")):
-    if not pattern.match(p.name):
-        continue
-    h = hashlib.sha256()
-    with p.open("rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
-            h.update(chunk)
-    files[p.name] = h.hexdigest()
+
+def sha256_file(entry):
+    with open(entry.path, "rb") as f:
+        return entry.name, hashlib.file_digest(f, "sha256").hexdigest()
+
+
+# scandir needs no per-file stat; the cheap suffix test skips the regex for most names.
+match = pattern.match
+with os.scandir(data_dir) as it:
+    entries = [e for e in it if e.name.endswith(".txt") and match(e.name)]
+entries.sort(key=lambda e: e.name)
+
+# hashlib releases the GIL while hashing, so threads are enough to use several cores.
+with ThreadPoolExecutor() as ex:
+    files = dict(ex.map(sha256_file, entries))
 
 manifest = {"files": files}
 
+# files is already in name order, so no sort_keys; stream to disk instead of building the string.
 out = data_dir / "manifest.json"
-out.write_text(json.dumps(manifest, indent=2, sort_keys=True) + "\n", encoding="utf-8")
+with out.open("w", encoding="utf-8") as f:
+    json.dump(manifest, f, indent=2)
+    f.write("\n")
 
 print(f"written {out} with {len(files)} entries")
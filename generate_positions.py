@@ -4,15 +4,23 @@
 from __future__ import annotations
 
 import argparse
+import array
+import os
 import time
-from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from itertools import combinations, islice
+from math import comb
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Tuple
 
 import chess
 import chess.gaviota
 
 import filters
+from helpers import CHEB
 
 
 PIECE_ORDER = "KQRBNP"
@@ -30,6 +38,12 @@ LETTER_TO_PIECE_TYPE = {
 
 ALL_SQUARES_MASK = (1 << 64) - 1
 
+# libgtb block cache, per process (each worker opens its own tablebase).
+GTB_CACHE_BYTES = 32 << 20
+# Share of the cache reserved for WDL, out of 128. Only probe_dtm is called here, so most of
+# the cache goes to DTM; a small WDL share is kept so libgtb never gets an empty WDL cache.
+GTB_CACHE_WDL_FRACTION = 8
+
 # Pawns cannot be on rank 1 or rank 8.
 # square index: a1=0 .. h8=63, rank = sq>>3 in [0..7]
 PAWN_SQUARES_MASK = 0
@@ -39,23 +53,28 @@ for _sq in range(64):
         PAWN_SQUARES_MASK |= (1 << _sq)
 
 
+# Piece types in PIECE_ORDER, aligned with Material.white_counts / black_counts.
+PIECE_ORDER_TYPES = [LETTER_TO_PIECE_TYPE[p] for p in PIECE_ORDER]
+
+
 @dataclass(frozen=True)
 class Material:
     white: str  # canonical, e.g. "KPP"
     black: str  # canonical, e.g. "KR"
 
-    @property
-    def key(self) -> str:
-        # Example: "kp_vs_kr"
-        return f"{self.white.lower()}_vs_{self.black.lower()}"
+    # Derived once in __post_init__ (the dataclass is immutable).
+    key: str = field(init=False, repr=False, compare=False)  # e.g. "kp_vs_kr"
+    filename: str = field(init=False, repr=False, compare=False)
+    total_pieces: int = field(init=False, repr=False, compare=False)
+    white_counts: Tuple[int, ...] = field(init=False, repr=False, compare=False)  # per PIECE_ORDER letter
+    black_counts: Tuple[int, ...] = field(init=False, repr=False, compare=False)
 
-    @property
-    def filename(self) -> str:
-        return f"{self.white}_{self.black}.txt"
-
-    @property
-    def total_pieces(self) -> int:
-        return len(self.white) + len(self.black)
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "key", f"{self.white.lower()}_vs_{self.black.lower()}")
+        object.__setattr__(self, "filename", f"{self.white}_{self.black}.txt")
+        object.__setattr__(self, "total_pieces", len(self.white) + len(self.black))
+        object.__setattr__(self, "white_counts", tuple(self.white.count(p) for p in PIECE_ORDER))
+        object.__setattr__(self, "black_counts", tuple(self.black.count(p) for p in PIECE_ORDER))
 
 
 def canonicalize_material(s: str) -> str:
@@ -76,6 +95,12 @@ def parse_args() -> argparse.Namespace:
     )
     p.add_argument("--w", required=True, help="White material, e.g. KPP, KR, KQ")
     p.add_argument("--b", required=True, help="Black material, e.g. K, KP, KR")
+    p.add_argument(
+        "--jobs",
+        type=int,
+        default=0,
+        help="Worker processes (default: all CPUs; 1 runs in-process)",
+    )
     return p.parse_args()
 
 
@@ -146,21 +171,13 @@ def groups_for_generation(material: Material) -> List[Tuple[bool, int, int]]:
 
     Each group is: (is_white, piece_type, count)
     """
-    def counts(s: str) -> Dict[str, int]:
-        return {p: s.count(p) for p in PIECE_ORDER}
-
-    w_counts = counts(material.white)
-    b_counts = counts(material.black)
-
     groups: List[Tuple[bool, int, int]] = []
-    for p in PIECE_ORDER:
-        c = w_counts[p]
+    for pt, c in zip(PIECE_ORDER_TYPES, material.white_counts):
         if c:
-            groups.append((True, LETTER_TO_PIECE_TYPE[p], c))
-    for p in PIECE_ORDER:
-        c = b_counts[p]
+            groups.append((True, pt, c))
+    for pt, c in zip(PIECE_ORDER_TYPES, material.black_counts):
         if c:
-            groups.append((False, LETTER_TO_PIECE_TYPE[p], c))
+            groups.append((False, pt, c))
     return groups
 
 
@@ -180,6 +197,16 @@ def open_tablebase_native_fixed(dirs: list[Path]) -> Any:
 
     tb = chess.gaviota.NativeTablebase(lib)
 
+    # libgtb reads tables through its own block cache (python-chess sets 1 MiB, 50/128 of it
+    # for WDL probes). Only DTM probes are made here: a larger cache, mostly for DTM,
+    # keeps hot blocks resident instead of re-reading and decompressing them.
+    # _tbcache_restart is private python-chess API: fall back to its default cache if absent.
+    tbcache_restart = getattr(tb, "_tbcache_restart", None)
+    if callable(tbcache_restart):
+        tbcache_restart(GTB_CACHE_BYTES, GTB_CACHE_WDL_FRACTION)
+    else:
+        print("warning: NativeTablebase._tbcache_restart not found; using the default libgtb cache")
+
     # Be explicit about the C signature expected by python-chess.
     # python-chess calls: tb_restart(verbosity:int, compression_scheme:int, paths:char**)
     tb.libgtb.tb_restart.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_char_p)]
@@ -204,10 +231,9 @@ def open_tablebase_native_fixed(dirs: list[Path]) -> Any:
 
     tb._tb_restart = _tb_restart_null_terminated  # type: ignore[attr-defined]
 
-    # Now add directories normally.
-    tb.add_directory(str(dirs[0]))
-    for d in dirs[1:]:
-        tb.add_directory(str(d))
+    # Register every directory, then restart once: add_directory() restarts libgtb per call.
+    tb.paths.extend(str(d) for d in dirs)
+    tb._tb_restart()
 
     return tb
 
@@ -216,66 +242,45 @@ def open_tablebase_native_fixed(dirs: list[Path]) -> Any:
 # Fast generation helpers (bitboards)
 # -----------------------------------
 
-def _iter_bits(mask: int) -> Iterable[int]:
-    """Yield square indices for each 1 bit in mask (ascending)."""
-    while mask:
-        lsb = mask & -mask
-        sq = lsb.bit_length() - 1
-        yield sq
-        mask ^= lsb
+# _BYTE_SQUARES[i][b] = squares of the bits set in byte b, at byte offset i of a mask.
+_BYTE_SQUARES: List[List[Tuple[int, ...]]] = [
+    [tuple((i << 3) | k for k in range(8) if (b >> k) & 1) for b in range(256)]
+    for i in range(8)
+]
+
+
+# Same layout, holding shared 1-tuples (sq,): single-piece groups iterate these directly.
+_BYTE_SINGLETONS: List[List[Tuple[Tuple[int], ...]]] = [
+    [tuple((sq,) for sq in squares) for squares in row]
+    for row in _BYTE_SQUARES
+]
+
+
+def _mask_squares(mask: int) -> List[int]:
+    """
+    Square indices for each 1 bit in mask (ascending), as a list.
+    One table lookup per byte instead of one LSB step per bit.
+    """
+    t0, t1, t2, t3, t4, t5, t6, t7 = _BYTE_SQUARES
+    return [
+        *t0[mask & 0xFF], *t1[(mask >> 8) & 0xFF], *t2[(mask >> 16) & 0xFF], *t3[(mask >> 24) & 0xFF],
+        *t4[(mask >> 32) & 0xFF], *t5[(mask >> 40) & 0xFF], *t6[(mask >> 48) & 0xFF], *t7[(mask >> 56) & 0xFF],
+    ]
 
 
 def _iter_k_combos(mask: int, k: int) -> Iterable[Tuple[int, ...]]:
     """
-    Iterate combinations of k squares from a bitmask.
-    Optimized for k in {1,2,3}. Fallback for larger k.
+    Iterate combinations of k squares from a bitmask, in ascending lexicographic order.
+    The squares are listed once; itertools.combinations then runs the nested loops in C.
+    k == 1 (most groups) skips combinations and yields the shared 1-tuples of _BYTE_SINGLETONS.
     """
     if k == 1:
-        for a in _iter_bits(mask):
-            yield (a,)
-        return
-
-    if k == 2:
-        m1 = mask
-        while m1:
-            l1 = m1 & -m1
-            a = l1.bit_length() - 1
-            m1 ^= l1
-
-            m2 = mask & ~((1 << (a + 1)) - 1)  # keep bits > a
-            while m2:
-                l2 = m2 & -m2
-                b = l2.bit_length() - 1
-                m2 ^= l2
-                yield (a, b)
-        return
-
-    if k == 3:
-        m1 = mask
-        while m1:
-            l1 = m1 & -m1
-            a = l1.bit_length() - 1
-            m1 ^= l1
-
-            m2 = mask & ~((1 << (a + 1)) - 1)  # bits > a
-            while m2:
-                l2 = m2 & -m2
-                b = l2.bit_length() - 1
-                m2 ^= l2
-
-                m3 = m2 & ~((1 << (b + 1)) - 1)  # bits > b (and already > a)
-                while m3:
-                    l3 = m3 & -m3
-                    c = l3.bit_length() - 1
-                    m3 ^= l3
-                    yield (a, b, c)
-        return
-
-    # Fallback (should not happen for total pieces <= 5 unless you allow 3+ identical pieces).
-    import itertools
-    squares = list(_iter_bits(mask))
-    for combo in itertools.combinations(squares, k):
-        yield combo
+        t0, t1, t2, t3, t4, t5, t6, t7 = _BYTE_SINGLETONS
+        return [
+            *t0[mask & 0xFF], *t1[(mask >> 8) & 0xFF], *t2[(mask >> 16) & 0xFF], *t3[(mask >> 24) & 0xFF],
+            *t4[(mask >> 32) & 0xFF], *t5[(mask >> 40) & 0xFF], *t6[(mask >> 48) & 0xFF], *t7[(mask >> 56) & 0xFF],
+        ]
+    return combinations(_mask_squares(mask), k)
 
 
 def _build_king_adjacency_masks() -> List[int]:
@@ -315,137 +320,104 @@ def _build_square_color_masks() -> List[int]:
     return masks
 
 
-def _build_cheb_within_masks() -> List[List[int]]:
+KING_ADJ_MASK = _build_king_adjacency_masks()
+SQUARE_COLOR_MASK = _build_square_color_masks()
+
+
+def _build_cheb_band_masks() -> List[int]:
     """
-    CHEB_WITHIN[sq][d] = mask of squares with Chebyshev distance <= d from sq.
-    d in [0..7].
+    CHEB_BAND[(sq << 6) | (dmin << 3) | dmax] = mask of squares with Chebyshev distance
+    in [dmin, dmax] from sq, for dmin, dmax in [0..7] (empty when dmin > dmax).
+    Built from the CHEB distance bytes: one ring mask per distance, OR-ed into bands.
     """
-    out: List[List[int]] = [[0] * 8 for _ in range(64)]
+    out = [0] * (64 * 64)
     for s in range(64):
-        sf = s & 7
-        sr = s >> 3
-        for d in range(8):
-            m = 0
-            for sq in range(64):
-                f = sq & 7
-                r = sq >> 3
-                if max(abs(f - sf), abs(r - sr)) <= d:
-                    m |= (1 << sq)
-            out[s][d] = m
+        row = s << 6
+        rings = [0] * 8
+        for sq in range(64):
+            rings[CHEB[row | sq]] |= (1 << sq)
+        for dmin in range(8):
+            band = 0
+            for dmax in range(dmin, 8):
+                band |= rings[dmax]
+                out[row | (dmin << 3) | dmax] = band
     return out
 
 
-KING_ADJ_MASK = _build_king_adjacency_masks()
-SQUARE_COLOR_MASK = _build_square_color_masks()
-CHEB_WITHIN = _build_cheb_within_masks()
+CHEB_BAND = _build_cheb_band_masks()
 
 
 def apply_cheb_range(candidates_mask: int, center_sq: int, dmin: int, dmax: int) -> int:
     """
     Restrict candidates_mask to squares with Chebyshev distance in [dmin, dmax] from center_sq.
     """
-    if dmax < 0:
+    if dmax < 0 or dmin > 7:
         return 0
     if dmin < 0:
         dmin = 0
     if dmax > 7:
         dmax = 7
-    m = candidates_mask & CHEB_WITHIN[center_sq][dmax]
-    if dmin <= 0:
-        return m
-    return m & ~CHEB_WITHIN[center_sq][dmin - 1]
+    return candidates_mask & CHEB_BAND[(center_sq << 6) | (dmin << 3) | dmax]
 
 
-def _sliding_attacks(from_sq: int, to_sq: int, occupied: int, step: int) -> bool:
+def _white_attack_mask(white_pieces: List[Tuple[int, int]], occupied: int) -> int:
     """
-    Return True if a sliding piece on from_sq attacks to_sq along 'step' (±1, ±7, ±8, ±9),
-    given the occupied bitboard.
-    Assumes from_sq and to_sq are aligned on that ray.
-    """
-    sq = from_sq + step
-    while sq != to_sq:
-        if (occupied >> sq) & 1:
-            return False
-        sq += step
-    return True
-
+    Squares attacked by the white pieces in white_pieces (piece_type, square), white king excluded.
+    occupied: bitboard of all pieces except the black king.
 
-def _white_attacks_square(bk_sq: int, white_pieces: List[Tuple[int, int]], occupied: int) -> bool:
+    The black king never blocks a ray to its own square, so this one mask answers
+    "is BK attacked?" for every BK candidate of a placement. Sliders use python-chess's
+    occupancy-indexed attack tables (one dict lookup per ray direction).
     """
-    Determine if bk_sq is attacked by any white piece in white_pieces.
-    white_pieces: list of (piece_type, square) excluding the white king.
-    occupied: bitboard of all pieces (both colors); BK may be included.
-    """
-    bk_f = bk_sq & 7
-    bk_r = bk_sq >> 3
-
+    attacks = 0
     for pt, sq in white_pieces:
-        sf = sq & 7
-        sr = sq >> 3
-        df = bk_f - sf
-        dr = bk_r - sr
-
         if pt == chess.PAWN:
-            # White pawn attacks one rank up (towards increasing rank): (df, dr) in {(-1, +1), (+1, +1)}
-            if dr == 1 and (df == -1 or df == 1):
-                return True
-
+            attacks |= chess.BB_PAWN_ATTACKS[chess.WHITE][sq]
         elif pt == chess.KNIGHT:
-            adf = df if df >= 0 else -df
-            adr = dr if dr >= 0 else -dr
-            if (adf == 1 and adr == 2) or (adf == 2 and adr == 1):
-                return True
-
-        elif pt == chess.BISHOP or pt == chess.QUEEN:
-            if df != 0 and (df if df >= 0 else -df) == (dr if dr >= 0 else -dr):
-                # Diagonal: abs(df) == abs(dr)
-                step_f = 1 if df > 0 else -1
-                step_r = 1 if dr > 0 else -1
-                step = step_f + 8 * step_r  # NE=+9, NW=+7, SE=-7, SW=-9
-                if _sliding_attacks(sq, bk_sq, occupied, step):
-                    return True
-
-        if pt == chess.ROOK or pt == chess.QUEEN:
-            if df == 0 and dr != 0:
-                step = 8 if dr > 0 else -8
-                if _sliding_attacks(sq, bk_sq, occupied, step):
-                    return True
-            elif dr == 0 and df != 0:
-                step = 1 if df > 0 else -1
-                if _sliding_attacks(sq, bk_sq, occupied, step):
-                    return True
-
-    return False
+            attacks |= chess.BB_KNIGHT_ATTACKS[sq]
+        else:
+            if pt != chess.ROOK:
+                attacks |= chess.BB_DIAG_ATTACKS[sq][chess.BB_DIAG_MASKS[sq] & occupied]
+            if pt != chess.BISHOP:
+                attacks |= (
+                    chess.BB_RANK_ATTACKS[sq][chess.BB_RANK_MASKS[sq] & occupied]
+                    | chess.BB_FILE_ATTACKS[sq][chess.BB_FILE_MASKS[sq] & occupied]
+                )
+    return attacks
 
 
 def _estimate_branching(mask: int, count: int) -> int:
     """
-    Cheap heuristic to order groups: smaller candidate space first.
+    Number of ways to place `count` same pieces on the candidate squares (orders groups: smaller first).
     """
-    n = mask.bit_count()
-    # approximate combinations count for small counts
-    if count <= 1:
-        return n
-    if count == 2:
-        return (n * (n - 1)) // 2
-    if count == 3:
-        return (n * (n - 1) * (n - 2)) // 6
-    return n ** count
+    return comb(mask.bit_count(), count)
 
 
-def generate_valid_square_placements(material: Material, hints: Optional[Mapping[str, Any]]) -> Iterable[Tuple[int, int, List[Tuple[bool, int, Tuple[int, ...]]]]]:
+def generate_valid_square_placements(
+    material: Material,
+    hints: Optional[Mapping[str, Any]],
+    outer_sq: Optional[int] = None,
+) -> Iterable[Tuple[int, int, List[Tuple[bool, int, Tuple[int, ...]]]]]:
     """
     Generate ONLY "valid positions" per spec, without building a Board:
       - White to move (handled later)
       - No pawn on rank 1/8 (enforced by pawn masks)
       - Kings not adjacent (enforced by BK choice)
-      - Black king not in check by White (checked via _white_attacks_square)
+      - Black king not in check by White (checked via _white_attack_mask)
 
     Hints (optional) can include:
       - "piece_masks": {(is_white: bool, piece_type: int): bitmask}
       - "wk_to_pawn_cheb": (dmin, dmax)   # used only if exactly one pawn exists (any color) with count==1
       - "bk_to_pawn_cheb": (dmin, dmax)   # same
       - "bishops_same_color": bool        # if True and there is exactly one bishop each side (count==1)
+
+    outer_sq (optional) restricts the outermost loop to one square: the single pawn anchor
+    square when there is one, the WK square otherwise. Concatenating the outputs for
+    outer_sq = 0..63 gives the full sequence, in order (used to shard work across processes).
+
+    The yielded pieces list is shared by consecutive BK squares of the same placement
+    (and a new list otherwise, so identity tells that only BK changed):
+    read it before advancing the generator, do not mutate it.
     """
     hints = hints or {}
     piece_masks: Mapping[Tuple[bool, int], int] = hints.get("piece_masks", {}) or {}
@@ -485,12 +457,25 @@ def generate_valid_square_placements(material: Material, hints: Optional[Mapping
     has_one_bb = any((not is_w) and pt == chess.BISHOP and cnt == 1 for (is_w, pt, cnt, _m) in ngroups)
     use_bishop_color_hint = bishops_same_color and has_one_wb and has_one_bb
 
+    # Bishop color state in recursion: 0 = not anchored yet, 1 + (file+rank)%2 once anchored.
+    # Per group, candidate masks are pre-ANDed for each state so rec_build only does one indexed load.
+    anchors_bishop_color: List[bool] = []
+    allowed_by_color: List[Tuple[int, int, int]] = []
+    for is_w, pt, cnt, m in ngroups:
+        hinted = use_bishop_color_hint and pt == chess.BISHOP and cnt == 1
+        anchors_bishop_color.append(hinted)
+        if hinted:
+            allowed_by_color.append((m, m & SQUARE_COLOR_MASK[0], m & SQUARE_COLOR_MASK[1]))
+        else:
+            allowed_by_color.append((m, m, m))
+
     # Prepare list of indices for recursion, ordered by branching.
     rec_indices = list(range(len(ngroups)))
     if pawn_anchor_index is not None:
         rec_indices.remove(pawn_anchor_index)
 
-    # Sort remaining groups by estimated branching (smaller first).
+    # Sort remaining groups by branching (smaller first), once for all outer squares:
+    # group masks do not depend on the anchor or WK square.
     # For count>1, combinations grow fast; this helps a lot when masks are narrow.
     def rec_sort_key(idx: int) -> int:
         _is_w, _pt, _cnt, _m = ngroups[idx]
@@ -501,6 +486,19 @@ def generate_valid_square_placements(material: Material, hints: Optional[Mapping
     # Pre-allocate chosen squares per ngroup, to avoid per-node dict allocations.
     chosen: List[Tuple[int, ...]] = [()] * len(ngroups)
 
+    # White non-king pieces as (piece_type, square) slots for the BK attack check,
+    # overwritten in place as groups are placed. Each white group owns `count` slots
+    # starting at white_slot[idx] and reuses interned (pt, sq) pairs, so leaves allocate nothing.
+    white_slot: List[int] = [0] * len(ngroups)
+    white_pairs: List[Optional[List[Tuple[int, int]]]] = [None] * len(ngroups)
+    n_white = 0
+    for gi, (is_white, pt, count, _m) in enumerate(ngroups):
+        if is_white:
+            white_slot[gi] = n_white
+            white_pairs[gi] = [(pt, s) for s in range(64)]
+            n_white += count
+    white_pieces: List[Tuple[int, int]] = [(0, 0)] * n_white
+
     # Candidate masks for kings (hints may include them; rare but supported).
     wk_mask_hint = piece_masks.get((True, chess.KING), ALL_SQUARES_MASK)
     bk_mask_hint = piece_masks.get((False, chess.KING), ALL_SQUARES_MASK)
@@ -512,74 +510,96 @@ def generate_valid_square_placements(material: Material, hints: Optional[Mapping
         _isw, _pt, _cnt, _m = ngroups[pawn_anchor_index]
         pawn_mask_anchor = _m  # already includes PAWN legality + hint masks
 
-    def rec_build(i: int, used: int, bishop_color: Optional[int], wk_sq: int) -> Iterable[Tuple[int, int, List[Tuple[bool, int, Tuple[int, ...]]]]]:
+    # Per-level constants of the placement loop (level i places group rec_indices[i]).
+    n_levels = len(rec_indices)
+    level_count = [ngroups[idx][2] for idx in rec_indices]
+    level_allowed = [allowed_by_color[idx] for idx in rec_indices]
+    level_anchors = [anchors_bishop_color[idx] for idx in rec_indices]
+    level_pairs = [white_pairs[idx] for idx in rec_indices]
+    level_slot = [white_slot[idx] for idx in rec_indices]
+
+    def rec_build(used0: int, wk_sq: int) -> Iterable[Tuple[int, int, List[Tuple[bool, int, Tuple[int, ...]]]]]:
         """
         Place all non-king groups (except BK), then choose BK last under:
           - not used
           - not adjacent to WK
           - optional bk-to-pawn distance (if single pawn anchor)
           - BK not attacked by white pieces
-        """
-        if i == len(rec_indices):
-            used_no_bk = used
-
-            # Build compact list of white pieces (excluding WK) for BK attack check.
-            white_pieces: List[Tuple[int, int]] = []
-            for (is_white, pt, _cnt, _m), sqs in zip(ngroups, chosen):
-                if is_white:
-                    for s in sqs:
-                        white_pieces.append((pt, s))
-
-            bk_candidates = (ALL_SQUARES_MASK & bk_mask_hint) & ~used_no_bk & ~KING_ADJ_MASK[wk_sq]
-
-            if has_single_pawn_anchor and pawn_sq_anchor is not None and bk_to_pawn is not None:
-                dmin, dmax = bk_to_pawn
-                bk_candidates = apply_cheb_range(bk_candidates, pawn_sq_anchor, dmin, dmax)
 
-            for bk_sq in _iter_bits(bk_candidates):
-                occ = used_no_bk | (1 << bk_sq)
-                if _white_attacks_square(bk_sq, white_pieces, occ):
-                    continue
-
-                pieces_out: List[Tuple[bool, int, Tuple[int, ...]]] = []
-                for (is_white, pt, _cnt, _m), sqs in zip(ngroups, chosen):
-                    pieces_out.append((is_white, pt, sqs))
-                yield (wk_sq, bk_sq, pieces_out)
+        Depth-first over the levels with an explicit stack (one combo iterator per level),
+        so leaves are yielded straight from this frame instead of through nested `yield from`.
+        """
+        level_iter: List[Optional[Iterator[Tuple[int, ...]]]] = [None] * n_levels
+        level_used = [used0] * (n_levels + 1)  # used mask before placing level i
+        level_color = [0] * (n_levels + 1)  # bishop color state before placing level i
+
+        bk_base = (ALL_SQUARES_MASK & bk_mask_hint) & ~KING_ADJ_MASK[wk_sq]
+        if has_single_pawn_anchor and pawn_sq_anchor is not None and bk_to_pawn is not None:
+            dmin, dmax = bk_to_pawn
+            bk_base = apply_cheb_range(bk_base, pawn_sq_anchor, dmin, dmax)
+        # BK zone around WK (and pawn distance hint) leaves no square: skip the whole subtree.
+        if not bk_base & ~used0:
             return
 
-        idx = rec_indices[i]
-        is_white, pt, count, allowed = ngroups[idx]
-
-        candidates = allowed & ~used
-
-        # Bishop color parity constraint (same-color bishops) if requested.
-        if use_bishop_color_hint and pt == chess.BISHOP and count == 1:
-            if bishop_color is not None:
-                candidates &= SQUARE_COLOR_MASK[bishop_color]
+        i = 0
+        while i >= 0:
+            if i == n_levels:
+                used_no_bk = level_used[i]
+
+                bk_mask = bk_base & ~used_no_bk
+                if bk_mask and white_pieces:
+                    bk_mask &= ~_white_attack_mask(white_pieces, used_no_bk)
+                if bk_mask:
+                    # Same pieces for every BK square of this node.
+                    pieces_out = [(is_white, pt, sqs) for (is_white, pt, _cnt, _m), sqs in zip(ngroups, chosen)]
+                    for bk_sq in _mask_squares(bk_mask):
+                        yield (wk_sq, bk_sq, pieces_out)
+                i -= 1
+                continue
 
-        # Additional king-distance constraint to pawn can be applied early to WK by selecting WK before recursion.
-        # (handled outside)
+            used = level_used[i]
+            bishop_color = level_color[i]
+            it = level_iter[i]
+            if it is None:
+                # Includes the bishop color parity constraint (same-color bishops) if requested.
+                it = level_iter[i] = iter(_iter_k_combos(level_allowed[i][bishop_color] & ~used, level_count[i]))
+
+            combo = next(it, None)
+            if combo is None:
+                level_iter[i] = None
+                i -= 1
+                continue
 
-        for combo in _iter_k_combos(candidates, count):
             used2 = used
             for s in combo:
                 used2 |= (1 << s)
 
-            bishop_color2 = bishop_color
-            if use_bishop_color_hint and pt == chess.BISHOP and count == 1 and bishop_color2 is None:
+            pairs = level_pairs[i]
+            if pairs is not None:
+                j = level_slot[i]
+                for s in combo:
+                    white_pieces[j] = pairs[s]
+                    j += 1
+
+            if level_anchors[i] and bishop_color == 0:
                 # Anchor bishop color based on the first bishop placed (any side).
                 s0 = combo[0]
-                bishop_color2 = ((s0 & 7) + (s0 >> 3)) & 1
+                bishop_color = 1 + ((s0 ^ (s0 >> 3)) & 1)
 
-            chosen[idx] = combo
-            yield from rec_build(i + 1, used2, bishop_color2, wk_sq)
+            chosen[rec_indices[i]] = combo
+            i += 1
+            level_used[i] = used2
+            level_color[i] = bishop_color
 
     # WK outer loop, with optional constraints relative to the single pawn anchor.
     # If single pawn anchor exists, we place the pawn first; otherwise pawn is placed in recursion.
+    outer_mask = ALL_SQUARES_MASK if outer_sq is None else (1 << outer_sq)
     if pawn_anchor_index is not None:
-        for pawn_sq in _iter_bits(pawn_mask_anchor):
+        for pawn_sq in _mask_squares(pawn_mask_anchor & outer_mask):
             pawn_sq_anchor = pawn_sq
             chosen[pawn_anchor_index] = (pawn_sq,)
+            if pawn_anchor_color:
+                white_pieces[white_slot[pawn_anchor_index]] = (chess.PAWN, pawn_sq)
 
             # WK candidates: must respect wk_mask_hint and not overlap pawn.
             wk_candidates = (ALL_SQUARES_MASK & wk_mask_hint) & ~(1 << pawn_sq)
@@ -588,17 +608,17 @@ def generate_valid_square_placements(material: Material, hints: Optional[Mapping
                 dmin, dmax = wk_to_pawn
                 wk_candidates = apply_cheb_range(wk_candidates, pawn_sq, dmin, dmax)
 
-            for wk_sq in _iter_bits(wk_candidates):
+            for wk_sq in _mask_squares(wk_candidates):
                 used0 = (1 << pawn_sq) | (1 << wk_sq)
 
-                # Place remaining pieces; bishop_color starts None.
-                yield from rec_build(0, used0, None, wk_sq)
+                # Place remaining pieces; bishop color starts unanchored.
+                yield from rec_build(used0, wk_sq)
 
     else:
         # No pawn anchor: plain WK loop, then recurse placing all non-king pieces.
-        for wk_sq in _iter_bits(ALL_SQUARES_MASK & wk_mask_hint):
+        for wk_sq in _mask_squares(outer_mask & wk_mask_hint):
             used0 = 1 << wk_sq
-            yield from rec_build(0, used0, None, wk_sq)
+            yield from rec_build(used0, wk_sq)
 
 
 # ----------------------------
@@ -615,7 +635,9 @@ def _new_empty_board() -> chess.Board:
     return b
 
 
-_HAS_CLEAR_BOARD = hasattr(_new_empty_board(), "clear_board")
+# Empty White-to-move board; fresh boards are copied from it instead of re-running the setup.
+_EMPTY_BOARD_PROTO = _new_empty_board()
+_HAS_CLEAR_BOARD = hasattr(_EMPTY_BOARD_PROTO, "clear_board")
 
 
 def _fill_board_inplace(
@@ -661,27 +683,85 @@ def dtm_stm_to_white(dtm_stm: int, stm_color: bool) -> int:
     return -dtm_stm
 
 
-def probe_dtm_only_white_pov(tablebase: Any, board: chess.Board) -> Tuple[int, Optional[int]]:
+# probe_dtm_only_white_pov() results shared by every probe of the run (one tablebase set
+# per process): roots and the children probed by filters, so a child reached from several
+# roots costs one mate/stalemate check and one TB probe.
+# Bounded by a reset instead of LRU bookkeeping: cheaper per hit, and a run only rarely fills it.
+_PROBE_CACHE: Dict[Tuple[int, ...], Tuple[int, Optional[int]]] = {}
+_PROBE_CACHE_MAX = 1 << 20
+# [hits, misses] of _PROBE_CACHE in this process, reported per shard in RunStats.
+_PROBE_CACHE_COUNTS = [0, 0]
+
+
+def _probe_cache_key(board: chess.Board) -> Optional[Tuple[int, ...]]:
+    """
+    Key of the position up to the left-right mirror, which preserves the outcome and DTM
+    when there are no castling rights (always the case here). Kings are implied by the
+    color masks. None when an en passant square is set (rare; probed directly).
+    """
+    if board.ep_square is not None:
+        return None
+    key = (board.turn, board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK],
+           board.pawns, board.knights, board.bishops, board.rooks, board.queens)
+    flip = chess.flip_horizontal
+    mirrored = (key[0],) + tuple(flip(bb) for bb in key[1:])
+    return key if key <= mirrored else mirrored
+
+
+def probe_dtm_only_white_pov(
+    tablebase: Any,
+    board: chess.Board,
+    has_legal_move: bool = False,
+) -> Tuple[int, Optional[int]]:
     """
     Probe using ONLY probe_dtm() and normalize to White's perspective.
+    Memoized across positions by _probe_cache_key.
+
+    has_legal_move: the caller already knows the side to move has a legal move
+    (e.g. the root passed filter_notb_generic), so the checkmate/stalemate
+    checks, which generate legal moves, are skipped.
 
     Returns:
       - wdl_white: int in {-1, 0, +1} from White's perspective
       - dtm_white: Optional[int] in plies from White's perspective (None if draw)
     """
-    if len(board.piece_map()) == 2:
-        return 0, None
+    key = _probe_cache_key(board)
+    if key is None:
+        return _probe_dtm_white_pov(tablebase, board, has_legal_move)
+    out = _PROBE_CACHE.get(key)
+    if out is not None:
+        _PROBE_CACHE_COUNTS[0] += 1
+        return out
+    _PROBE_CACHE_COUNTS[1] += 1
+    out = _probe_dtm_white_pov(tablebase, board, has_legal_move)
+    if len(_PROBE_CACHE) >= _PROBE_CACHE_MAX:
+        _PROBE_CACHE.clear()
+    _PROBE_CACHE[key] = out
+    return out
 
-    if board.is_checkmate():
-        wdl_stm = -1  # side to move is checkmated
-        dtm_stm = 0
-        wdl_white = wdl_stm if board.turn == chess.WHITE else -wdl_stm
-        dtm_white = dtm_stm_to_white(dtm_stm, board.turn)
-        return wdl_white, dtm_white
 
-    if board.is_stalemate():
+def _probe_dtm_white_pov(
+    tablebase: Any,
+    board: chess.Board,
+    has_legal_move: bool,
+) -> Tuple[int, Optional[int]]:
+    """
+    Uncached body of probe_dtm_only_white_pov().
+    """
+    if board.occupied.bit_count() == 2:
         return 0, None
 
+    # One legal-move probe decides both terminal cases (is_checkmate/is_stalemate would run two).
+    if not has_legal_move and next(board.generate_legal_moves(), None) is None:
+        if board.checkers_mask():
+            wdl_stm = -1  # side to move is checkmated
+            dtm_stm = 0
+            wdl_white = wdl_stm if board.turn == chess.WHITE else -wdl_stm
+            dtm_white = dtm_stm_to_white(dtm_stm, board.turn)
+            return wdl_white, dtm_white
+
+        return 0, None  # stalemate
+
     dtm_stm = tablebase.probe_dtm(board)
     if dtm_stm == 0:
         return 0, None
@@ -693,79 +773,351 @@ def probe_dtm_only_white_pov(tablebase: Any, board: chess.Board) -> Tuple[int, O
     return wdl_white, dtm_white
 
 
-def build_tb_info_with_probe(
-    tablebase: Any,
-    board: chess.Board,
-    wdl_white: int,
-    dtm_white: Optional[int],
-) -> Dict[str, Any]:
+class TBMove(NamedTuple):
+    """
+    Per-move probe result returned by tb["probe_move"], White POV for the child position.
     """
-    Build TB info dict for filters, with an on-demand per-move probe:
+    uci: str
+    wdl: int
+    dtm: Optional[int]
+
+
+class TBProbe:
+    """
+    TB info dict for filters, with an on-demand per-move probe:
       - wdl: int {-1,0,+1}, White POV
       - dtm: Optional[int], White POV (None if draw)
-      - probe_move: callable(move) -> {uci, wdl, dtm}, White POV for the child
+      - probe_move: callable(move) -> TBMove(uci, wdl, dtm), White POV for the child
+      - probe_move_wdl: callable(move) -> int, the child wdl only (same cache as probe_move)
+      - probe_wdls: callable() -> array('b') of wdl for every legal move (generation order), White POV
+      - legal_moves: callable() -> list of the root legal moves, generated once (do not mutate)
+
+    One instance serves every root position of a run: reset() points it at the next root and
+    empties the per-root caches, so the TB stage allocates no closures or dicts per position.
     """
-    cache: Dict[str, Dict[str, Any]] = {}
 
-    def probe_move(move: chess.Move) -> Dict[str, Any]:
-        key = move.uci()
-        cached = cache.get(key)
+    def __init__(self, tablebase: Any) -> None:
+        self.tablebase = tablebase
+        self.board: Optional[chess.Board] = None
+        self.cache: Dict[chess.Move, TBMove] = {}
+        self.wdls = array.array("b")
+        self.legal: List[chess.Move] = []
+        self.info: Dict[str, Any] = {
+            "wdl": 0,
+            "dtm": None,
+            "probe_move": self.probe_move,
+            "probe_move_wdl": self.probe_move_wdl,
+            "probe_wdls": self.probe_wdls,
+            "legal_moves": self.legal_moves,
+        }
+
+    def reset(self, board: chess.Board, wdl_white: int, dtm_white: Optional[int]) -> Dict[str, Any]:
+        """
+        Bind to a new root position; returns the info dict to pass to the TB filters.
+        """
+        self.board = board
+        self.cache.clear()
+        del self.wdls[:]
+        self.legal.clear()
+        info = self.info
+        info["wdl"] = wdl_white
+        info["dtm"] = dtm_white
+        return info
+
+    def probe_move(self, move: chess.Move) -> TBMove:
+        # Keyed by the Move itself: hashing it is cheaper than formatting move.uci().
+        cached = self.cache.get(move)
         if cached is not None:
             return cached
 
+        board = self.board
         board.push(move)
-        w2, d2 = probe_dtm_only_white_pov(tablebase, board)
+        w2, d2 = probe_dtm_only_white_pov(self.tablebase, board)
         board.pop()
 
-        out = {
-            "uci": key,
-            "wdl": w2,
-            "dtm": d2,
-        }
-        cache[key] = out
+        out = TBMove(move.uci(), w2, d2)
+        self.cache[move] = out
         return out
 
-    return {
-        "wdl": wdl_white,
-        "dtm": dtm_white,
-        "probe_move": probe_move,
-    }
+    def probe_move_wdl(self, move: chess.Move) -> int:
+        cached = self.cache.get(move)
+        if cached is not None:
+            return cached.wdl
+        return self.probe_move(move).wdl
+
+    def legal_moves(self) -> List[chess.Move]:
+        # Generated once per root position, shared by probe_wdls and the filters.
+        legal = self.legal
+        if not legal:
+            legal.extend(self.board.generate_legal_moves())
+        return legal
 
+    def probe_wdls(self) -> array.array:
+        # Computed once, through probe_move so both share the per-move cache.
+        wdls = self.wdls
+        if not wdls:
+            wdls.extend(map(self.probe_move_wdl, self.legal_moves()))
+        return wdls
 
-def encode_record(material: Material, board: chess.Board) -> str:
+
+# bytes.translate table: square index (0..63) -> its ALPHABET_64 character.
+_SQUARE_TO_ALPHABET = ALPHABET_64.encode("ascii").ljust(256, b"?")
+
+
+def encode_record(wk_sq: int, bk_sq: int, pieces: List[Tuple[bool, int, Tuple[int, ...]]]) -> bytes:
     """
     Encode the position as a fixed-length record:
       - White pieces (KQRBNP order), then Black pieces (KQRBNP)
       - For identical pieces, squares sorted by index
       - Each square encoded by one char via ALPHABET_64[0..63]
+    Returned as ASCII bytes, ready to be appended to the output buffer.
+
+    Reads the generator placement directly: its groups already come in KQRBNP order,
+    White then Black, with ascending squares within a group.
+    """
+    white = [wk_sq]
+    black = [bk_sq]
+    for is_white, _pt, sqs in pieces:
+        if is_white:
+            white += sqs
+        else:
+            black += sqs
+    return bytes(white + black).translate(_SQUARE_TO_ALPHABET)
+
+
+@dataclass
+class RunStats:
+    """
+    Counters of one generation run (or of one shard of it); shards are combined with merge().
     """
-    per: Dict[Tuple[bool, int], List[int]] = {}
-    for sq, piece in board.piece_map().items():
-        is_white = piece.color == chess.WHITE
-        key = (is_white, piece.piece_type)
-        per.setdefault(key, []).append(sq)
+    candidates_total: int = 0
+    valid_positions: int = 0
 
-    for k in per:
-        per[k].sort()
+    rejected_notb_generic: int = 0
+    rejected_notb_specific: int = 0
+    passed_notb: int = 0
 
-    out_chars: List[str] = []
+    rejected_tb_generic: int = 0
+    rejected_tb_specific: int = 0
+    accepted: int = 0
 
-    def emit_side(is_white: bool, mat: str):
-        for letter in PIECE_ORDER:
-            pt = LETTER_TO_PIECE_TYPE[letter]
-            count = mat.count(letter)
-            if count == 0:
+    # Accepted-position stats (root outcome, White POV).
+    accepted_win: int = 0
+    accepted_draw: int = 0
+    accepted_loss: int = 0
+
+    # DTM of accepted positions split by winner (positive values only), reduced at the end.
+    dtm_white: array.array = field(default_factory=lambda: array.array("i"))
+    dtm_black: array.array = field(default_factory=lambda: array.array("i"))
+
+    # Cross-position probe cache (probe_dtm_only_white_pov) lookups.
+    probe_cache_hits: int = 0
+    probe_cache_misses: int = 0
+
+    tb_opened: bool = False
+
+    def merge(self, other: "RunStats") -> None:
+        for name in (
+            "candidates_total", "valid_positions",
+            "rejected_notb_generic", "rejected_notb_specific", "passed_notb",
+            "rejected_tb_generic", "rejected_tb_specific", "accepted",
+            "accepted_win", "accepted_draw", "accepted_loss",
+            "probe_cache_hits", "probe_cache_misses",
+        ):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.dtm_white.extend(other.dtm_white)
+        self.dtm_black.extend(other.dtm_black)
+        self.tb_opened = self.tb_opened or other.tb_opened
+
+
+class PositionPipeline:
+    """
+    Per-process generation state: filters, reusable board, lazily opened tablebase
+    (the Gaviota directories found by main() are only opened once a position passes Stage A).
+    run(outer_sq) processes one shard of the placement sequence (see
+    generate_valid_square_placements) and returns its records and stats.
+    """
+
+    def __init__(self, material: Material, gaviota_dirs: List[Path]) -> None:
+        self.material = material
+        self.hints = get_gen_hints(material)
+        self.gaviota_dirs = gaviota_dirs
+        self.tablebase: Any = None  # lazy init
+        self.tb_probe: Optional[TBProbe] = None
+
+        # Stage functions bound once: the per-position loop makes no module attribute lookups.
+        self.filter_notb_generic = filters.filter_notb_generic
+        self.filter_tb_generic = filters.filter_tb_generic
+        self.filter_notb_specific = get_filter_fn(f"filter_notb_{material.key}")
+        self.filter_notb_placement = get_filter_fn(f"filter_notb_placement_{material.key}")
+        self.filter_tb_specific = get_filter_fn(f"filter_tb_{material.key}")
+
+        # Piece cache avoids re-allocating chess.Piece objects.
+        self.piece_cache: Dict[Tuple[bool, int], chess.Piece] = {
+            (color, pt): chess.Piece(pt, color)
+            for color in (chess.WHITE, chess.BLACK)
+            for pt in PIECE_ORDER_TYPES
+        }
+
+        # Board reuse if supported (significant speed win).
+        self.board = _EMPTY_BOARD_PROTO.copy(stack=False) if _HAS_CLEAR_BOARD else None
+
+    def close(self) -> None:
+        if self.tablebase is not None:
+            self.tablebase.close()
+            self.tablebase = None
+            self.tb_probe = None
+
+    def run(self, outer_sq: Optional[int] = None) -> Tuple[bytes, RunStats]:
+        material = self.material
+        filter_notb_generic = self.filter_notb_generic
+        filter_tb_generic = self.filter_tb_generic
+        filter_notb_specific = self.filter_notb_specific
+        filter_notb_placement = self.filter_notb_placement
+        filter_tb_specific = self.filter_tb_specific
+        piece_cache = self.piece_cache
+        black_king = piece_cache[(chess.BLACK, chess.KING)]
+        board = self.board
+        # Placement currently on the reused board (pieces list identity, king squares).
+        last_pieces: Optional[List[Tuple[bool, int, Tuple[int, ...]]]] = None
+        last_wk_sq = last_bk_sq = -1
+
+        st = RunStats()
+        hits0, misses0 = _PROBE_CACHE_COUNTS
+        # Accepted records (no separators, no newline), returned in one piece per shard.
+        out_buf = bytearray()
+
+        for wk_sq, bk_sq, pieces in generate_valid_square_placements(material, self.hints, outer_sq):
+            st.candidates_total += 1
+            st.valid_positions += 1  # generator already enforces the "valid position" spec
+
+            # Geometric part of the specific filter, on squares only: skips the board fill.
+            if filter_notb_placement is not None and not filter_notb_placement(wk_sq, bk_sq, pieces):
+                st.rejected_notb_specific += 1
+                continue
+
+            # Build a Board only for valid positions.
+            if board is not None:
+                if pieces is last_pieces and wk_sq == last_wk_sq:
+                    # Same placement node as the board holds: only the black king moved.
+                    board.remove_piece_at(last_bk_sq)
+                    board.set_piece_at(bk_sq, black_king)
+                    b = board
+                else:
+                    b = _fill_board_inplace(board, wk_sq, bk_sq, pieces, piece_cache)
+                    last_pieces = pieces
+                    last_wk_sq = wk_sq
+                last_bk_sq = bk_sq
+            else:
+                b = _EMPTY_BOARD_PROTO.copy(stack=False)
+                b.set_piece_at(wk_sq, piece_cache[(True, chess.KING)])
+                b.set_piece_at(bk_sq, piece_cache[(False, chess.KING)])
+                for is_white, pt, sqs in pieces:
+                    piece = piece_cache[(is_white, pt)]
+                    for s in sqs:
+                        b.set_piece_at(s, piece)
+
+            # Stage A: no-tablebase filters. The specific one goes first: mostly geometry,
+            # it rejects far more positions than the generic legal-move check.
+            if filter_notb_specific is not None and not filter_notb_specific(b):
+                st.rejected_notb_specific += 1
+                continue
+
+            if not filter_notb_generic(b):
+                st.rejected_notb_generic += 1
+                continue
+
+            st.passed_notb += 1
+
+            # Stage B: tablebase stage (lazy open).
+            tablebase = self.tablebase
+            if tablebase is None:
+                tablebase = self.tablebase = open_tablebase_native_fixed(self.gaviota_dirs)
+                self.tb_probe = TBProbe(tablebase)
+            tb_probe = self.tb_probe
+            st.tb_opened = True
+
+            # Probe only DTM for the root position first.
+            # filter_notb_generic guarantees at least two legal moves: no mate/stalemate checks.
+            wdl_white, dtm_white = probe_dtm_only_white_pov(tablebase, b, has_legal_move=True)
+
+            # TB info with on-demand per-move probe.
+            tb_info = tb_probe.reset(b, wdl_white, dtm_white)
+
+            if not filter_tb_generic(b, tb_info):
+                st.rejected_tb_generic += 1
+                continue
+
+            if filter_tb_specific is not None and not filter_tb_specific(b, tb_info):
+                st.rejected_tb_specific += 1
                 continue
-            squares = per.get((is_white, pt), [])
-            if len(squares) != count:
-                raise RuntimeError("Internal error: piece counts mismatch while encoding.")
-            for sq in squares:
-                out_chars.append(ALPHABET_64[sq])
 
-    emit_side(True, material.white)
-    emit_side(False, material.black)
+            # Accepted -> record + outcome byte.
+            out_buf += encode_record(wk_sq, bk_sq, pieces)
+            if wdl_white > 0:
+                out_buf += b"W"
+            elif wdl_white < 0:
+                out_buf += b"L"
+            else:
+                out_buf += b"D"
+            st.accepted += 1
+
+            # Update accepted-position stats (root outcome); DTM split by winner.
+            if wdl_white > 0:
+                st.accepted_win += 1
+                if dtm_white is not None:
+                    st.dtm_white.append(dtm_white)
+            elif wdl_white < 0:
+                st.accepted_loss += 1
+                if dtm_white is not None:
+                    st.dtm_black.append(-dtm_white)
+            else:
+                st.accepted_draw += 1
+
+        st.probe_cache_hits = _PROBE_CACHE_COUNTS[0] - hits0
+        st.probe_cache_misses = _PROBE_CACHE_COUNTS[1] - misses0
+        return bytes(out_buf), st
+
+
+def probe_cache_hit_rate(st: RunStats) -> float:
+    lookups = st.probe_cache_hits + st.probe_cache_misses
+    return (st.probe_cache_hits / lookups) if lookups else 0.0
+
+
+# Pipeline of a worker process, set by _init_worker.
+_WORKER_PIPELINE: Optional[PositionPipeline] = None
+
+
+def _init_worker(material: Material, gaviota_dirs: List[Path]) -> None:
+    global _WORKER_PIPELINE
+    # Each worker owns its tablebase handle. Pool workers leave through os._exit (no atexit
+    # handlers), so the handle is not closed explicitly: it goes away with the process.
+    _WORKER_PIPELINE = PositionPipeline(material, gaviota_dirs)
+
+
+def _run_worker_shard(outer_sq: int) -> Tuple[bytes, RunStats]:
+    assert _WORKER_PIPELINE is not None
+    return _WORKER_PIPELINE.run(outer_sq)
+
 
-    return "".join(out_chars)
+def _map_in_order_bounded(
+    ex: ProcessPoolExecutor,
+    fn: Any,
+    items: Iterable[int],
+    max_in_flight: int,
+) -> Iterator[Tuple[bytes, RunStats]]:
+    """
+    Like ex.map(fn, items), but with at most `max_in_flight` items submitted and not yet
+    consumed: a slow shard holds back at most that many finished results in memory,
+    instead of every later shard of the run. Results are yielded in item order.
+    """
+    it = iter(items)
+    pending: Deque[Future] = deque(ex.submit(fn, item) for item in islice(it, max_in_flight))
+    while pending:
+        result = pending.popleft().result()
+        for item in islice(it, 1):
+            pending.append(ex.submit(fn, item))
+        yield result
 
 
 def main() -> None:
@@ -785,10 +1137,8 @@ def main() -> None:
     if not callable(getattr(filters, "filter_tb_generic", None)):
         raise RuntimeError("filters.filter_tb_generic(board, tb) must exist and be callable.")
 
-    filter_notb_specific = get_filter_fn(f"filter_notb_{material.key}")
-    filter_tb_specific = get_filter_fn(f"filter_tb_{material.key}")
-
     hints = get_gen_hints(material)
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
 
     gaviota_root = Path("./gaviota")
     gaviota_dirs = find_gaviota_dirs(gaviota_root)
@@ -797,204 +1147,90 @@ def main() -> None:
     out_dir.mkdir(parents=True, exist_ok=True)
     out_path = out_dir / material.filename
 
-    # Counters.
-    candidates_total = 0
-    valid_positions = 0
-
-    rejected_notb_generic = 0
-    rejected_notb_specific = 0
-    passed_notb = 0
-
-    rejected_tb_generic = 0
-    rejected_tb_specific = 0
-    accepted = 0
-
-    # Accepted-position stats (root outcome, White POV).
-    accepted_win = 0
-    accepted_draw = 0
-    accepted_loss = 0
-
-    # DTM stats split by winner (positive values only).
-    dtm_white_count = 0
-    dtm_white_sum = 0
-    dtm_white_min: Optional[int] = None
-    dtm_white_max: Optional[int] = None
-
-    dtm_black_count = 0
-    dtm_black_sum = 0
-    dtm_black_min: Optional[int] = None
-    dtm_black_max: Optional[int] = None
-
-    tb_opened = False
+    total = RunStats()
 
     t0 = time.perf_counter()
     next_log_time = t0 + 60.0
 
     def log_progress() -> None:
         elapsed = time.perf_counter() - t0
-        rate_valid = (valid_positions / elapsed) if elapsed > 0 else 0.0
-        rate_accepted = (accepted / elapsed) if elapsed > 0 else 0.0
+        rate_valid = (total.valid_positions / elapsed) if elapsed > 0 else 0.0
+        rate_accepted = (total.accepted / elapsed) if elapsed > 0 else 0.0
 
         print(
             "progress:"
             f" elapsed={fmt_elapsed(elapsed)}"
-            f" candidates={candidates_total}"
-            f" passed_notb={passed_notb}"
-            f" accepted={accepted}"
+            f" candidates={total.candidates_total}"
+            f" passed_notb={total.passed_notb}"
+            f" accepted={total.accepted}"
             f" rate_valid={rate_valid:,.0f}/s"
             f" rate_accepted={rate_accepted:,.0f}/s"
-            f" | notb_rej_generic={rejected_notb_generic}"
-            f" notb_rej_specific={rejected_notb_specific}"
-            f" tb_rej_generic={rejected_tb_generic}"
-            f" tb_rej_specific={rejected_tb_specific}"
+            f" | notb_rej_generic={total.rejected_notb_generic}"
+            f" notb_rej_specific={total.rejected_notb_specific}"
+            f" tb_rej_generic={total.rejected_tb_generic}"
+            f" tb_rej_specific={total.rejected_tb_specific}"
+            f" probe_cache_hit={probe_cache_hit_rate(total):.1%}"
         )
 
-    # Piece cache avoids re-allocating chess.Piece objects.
-    piece_cache: Dict[Tuple[bool, int], chess.Piece] = {
-        (True, chess.KING): chess.Piece(chess.KING, chess.WHITE),
-        (False, chess.KING): chess.Piece(chess.KING, chess.BLACK),
-        (True, chess.QUEEN): chess.Piece(chess.QUEEN, chess.WHITE),
-        (False, chess.QUEEN): chess.Piece(chess.QUEEN, chess.BLACK),
-        (True, chess.ROOK): chess.Piece(chess.ROOK, chess.WHITE),
-        (False, chess.ROOK): chess.Piece(chess.ROOK, chess.BLACK),
-        (True, chess.BISHOP): chess.Piece(chess.BISHOP, chess.WHITE),
-        (False, chess.BISHOP): chess.Piece(chess.BISHOP, chess.BLACK),
-        (True, chess.KNIGHT): chess.Piece(chess.KNIGHT, chess.WHITE),
-        (False, chess.KNIGHT): chess.Piece(chess.KNIGHT, chess.BLACK),
-        (True, chess.PAWN): chess.Piece(chess.PAWN, chess.WHITE),
-        (False, chess.PAWN): chess.Piece(chess.PAWN, chess.BLACK),
-    }
-
-    # Board reuse if supported (significant speed win).
-    board_reuse = _HAS_CLEAR_BOARD
-    board = _new_empty_board() if board_reuse else None
-
-    with out_path.open("w", encoding="ascii", newline="") as f_out:
-        tablebase = None  # lazy init
-
-        for wk_sq, bk_sq, pieces in generate_valid_square_placements(material, hints):
-            candidates_total += 1
-            valid_positions += 1  # generator already enforces the "valid position" spec
+    # One shard per outermost square (pawn anchor or WK). Shards are independent subtrees;
+    # results are consumed in square order, so the output matches a sequential run.
+    outer_squares = range(64)
+
+    with ExitStack() as stack:
+        if jobs > 1:
+            ex = stack.enter_context(
+                ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(material, gaviota_dirs))
+            )
+            shard_results = _map_in_order_bounded(ex, _run_worker_shard, outer_squares, 2 * jobs)
+        else:
+            pipeline = PositionPipeline(material, gaviota_dirs)
+            stack.callback(pipeline.close)
+            shard_results = map(pipeline.run, outer_squares)
+
+        f_out = stack.enter_context(out_path.open("wb"))
+        for records, st in shard_results:
+            if records:
+                f_out.write(records)
+            total.merge(st)
+
             now = time.perf_counter()
             if now >= next_log_time:
                 log_progress()
                 next_log_time = now + 60.0
 
-            # Build a Board only for valid positions.
-            if board_reuse:
-                assert board is not None
-                b = _fill_board_inplace(board, wk_sq, bk_sq, pieces, piece_cache)
-            else:
-                b = _new_empty_board()
-                b.set_piece_at(wk_sq, piece_cache[(True, chess.KING)])
-                b.set_piece_at(bk_sq, piece_cache[(False, chess.KING)])
-                for is_white, pt, sqs in pieces:
-                    piece = piece_cache[(is_white, pt)]
-                    for s in sqs:
-                        b.set_piece_at(s, piece)
-
-            # Stage A: no-tablebase filters.
-            if not filters.filter_notb_generic(b):
-                rejected_notb_generic += 1
-                continue
-
-            if filter_notb_specific is not None and not filter_notb_specific(b):
-                rejected_notb_specific += 1
-                continue
-
-            passed_notb += 1
-
-            # Stage B: tablebase stage (lazy open).
-            if tablebase is None:
-                tablebase = open_tablebase_native_fixed(gaviota_dirs)
-                tb_opened = True
-
-            # Probe only DTM for the root position first.
-            wdl_white, dtm_white = probe_dtm_only_white_pov(tablebase, b)
-
-            # Build TB info with on-demand per-move probe.
-            tb_info = build_tb_info_with_probe(tablebase, b, wdl_white, dtm_white)
-
-            if not filters.filter_tb_generic(b, tb_info):
-                rejected_tb_generic += 1
-                continue
-
-            if filter_tb_specific is not None and not filter_tb_specific(b, tb_info):
-                rejected_tb_specific += 1
-                continue
-
-            # Accepted -> write record (no separators, no newline).
-            rec = encode_record(material, b)
-            outcome = "D"
-            if wdl_white > 0:
-                outcome = "W"
-            elif wdl_white < 0:
-                outcome = "L"
-            f_out.write(rec + outcome)
-            accepted += 1
-
-            # Update accepted-position stats (root outcome).
-            if wdl_white > 0:
-                accepted_win += 1
-            elif wdl_white < 0:
-                accepted_loss += 1
-            else:
-                accepted_draw += 1
-
-            # DTM stats split by winner.
-            if dtm_white is not None:
-                if wdl_white > 0:
-                    v = dtm_white
-                    dtm_white_count += 1
-                    dtm_white_sum += v
-                    if dtm_white_min is None or v < dtm_white_min:
-                        dtm_white_min = v
-                    if dtm_white_max is None or v > dtm_white_max:
-                        dtm_white_max = v
-                elif wdl_white < 0:
-                    v = abs(dtm_white)
-                    dtm_black_count += 1
-                    dtm_black_sum += v
-                    if dtm_black_min is None or v < dtm_black_min:
-                        dtm_black_min = v
-                    if dtm_black_max is None or v > dtm_black_max:
-                        dtm_black_max = v
-
-        if tablebase is not None:
-            tablebase.close()
-
     elapsed = time.perf_counter() - t0
 
     print("done:")
     print(f"  output: {out_path}")
     print(f"  elapsed: {fmt_elapsed(elapsed)}")
-    print(f"  candidates_total: {candidates_total}")
-    print(f"  valid_positions: {valid_positions}")
-    print(f"  passed_notb: {passed_notb}")
-    print(f"  accepted: {accepted}")
-    print(f"  rejected_notb_generic: {rejected_notb_generic}")
-    print(f"  rejected_notb_specific: {rejected_notb_specific}")
-    print(f"  rejected_tb_generic: {rejected_tb_generic}")
-    print(f"  rejected_tb_specific: {rejected_tb_specific}")
-
-    print(f"  accepted_win: {accepted_win}")
-    print(f"  accepted_draw: {accepted_draw}")
-    print(f"  accepted_loss: {accepted_loss}")
-
-    if dtm_white_count > 0:
-        dtm_white_avg = dtm_white_sum / dtm_white_count
-        print(f"  dtmWhiteMin: {dtm_white_min}")
-        print(f"  dtmWhiteMax: {dtm_white_max}")
+    print(f"  jobs: {jobs}")
+    print(f"  candidates_total: {total.candidates_total}")
+    print(f"  valid_positions: {total.valid_positions}")
+    print(f"  passed_notb: {total.passed_notb}")
+    print(f"  accepted: {total.accepted}")
+    print(f"  rejected_notb_generic: {total.rejected_notb_generic}")
+    print(f"  rejected_notb_specific: {total.rejected_notb_specific}")
+    print(f"  rejected_tb_generic: {total.rejected_tb_generic}")
+    print(f"  rejected_tb_specific: {total.rejected_tb_specific}")
+
+    print(f"  accepted_win: {total.accepted_win}")
+    print(f"  accepted_draw: {total.accepted_draw}")
+    print(f"  accepted_loss: {total.accepted_loss}")
+
+    if total.dtm_white:
+        dtm_white_avg = sum(total.dtm_white) / len(total.dtm_white)
+        print(f"  dtmWhiteMin: {min(total.dtm_white)}")
+        print(f"  dtmWhiteMax: {max(total.dtm_white)}")
         print(f"  dtmWhiteAvg: {dtm_white_avg:.2f}")
     else:
         print("  dtmWhiteMin: n/a")
         print("  dtmWhiteMax: n/a")
         print("  dtmWhiteAvg: n/a")
 
-    if dtm_black_count > 0:
-        dtm_black_avg = dtm_black_sum / dtm_black_count
-        print(f"  dtmBlackMin: {dtm_black_min}")
-        print(f"  dtmBlackMax: {dtm_black_max}")
+    if total.dtm_black:
+        dtm_black_avg = sum(total.dtm_black) / len(total.dtm_black)
+        print(f"  dtmBlackMin: {min(total.dtm_black)}")
+        print(f"  dtmBlackMax: {max(total.dtm_black)}")
         print(f"  dtmBlackAvg: {dtm_black_avg:.2f}")
     else:
         print("  dtmBlackMin: n/a")
@@ -1002,11 +1238,13 @@ def main() -> None:
         print("  dtmBlackAvg: n/a")
 
     if elapsed > 0:
-        print(f"  rate_valid_per_sec: {valid_positions/elapsed:,.0f}")
-        print(f"  rate_accepted_per_sec: {accepted/elapsed:,.0f}")
+        print(f"  rate_valid_per_sec: {total.valid_positions/elapsed:,.0f}")
+        print(f"  rate_accepted_per_sec: {total.accepted/elapsed:,.0f}")
 
-    print(f"  tb_opened: {tb_opened}")
-    if tb_opened:
+    print(f"  probe_cache_hits: {total.probe_cache_hits}")
+    print(f"  probe_cache_misses: {total.probe_cache_misses}")
+    print(f"  tb_opened: {total.tb_opened}")
+    if total.tb_opened:
         print(f"  gaviota_dirs: {[str(d) for d in gaviota_dirs]}")
     if hints:
         print(f"  gen_hints_used: True ({material.key})")
@@ -3,6 +3,22 @@
 from __future__ import annotations
 
 
+# Chebyshev (king-move) distance between squares a and b: CHEB[(a << 6) | b].
+CHEB = bytes(
+    max(abs((a & 7) - (b & 7)), abs((a >> 3) - (b >> 3)))
+    for a in range(64)
+    for b in range(64)
+)
+
+
+def _lsb(bb: int) -> int:
+    """
+    Square index of the lowest set bit of a bitboard. Callers must ensure bb != 0:
+    an empty bitboard gives -1, which would silently index CHEB.
+    """
+    return (bb & -bb).bit_length() - 1
+
+
 def mask_files(f_min: int, f_max: int) -> int:
     """
     Bitmask of squares with file in [f_min, f_max], where file a=0..h=7.
@@ -3,11 +3,13 @@
 
 from __future__ import annotations
 
-from typing import Any, Mapping, Optional, Tuple, List
+from typing import Any, Mapping, Optional, Tuple, List, Sequence
 import hashlib
+from functools import lru_cache
+from itertools import islice
 
 import chess
-from helpers import mask_files, mask_ranks
+from helpers import CHEB, _lsb, mask_files, mask_ranks
 
 
 # =============================================================================
@@ -20,7 +22,7 @@ from helpers import mask_files, mask_ranks
 # - Draws should be non-trivial: ideally an "only move" draw.
 #
 # IMPORTANT correctness note:
-# - tb["probe_move"](move) in generate_positions.py is cached by move.uci() only.
+# - tb["probe_move"](move) in generate_positions.py is cached by move only.
 #   That function is only correct for probing *root* legal moves.
 #   Do NOT call tb["probe_move"] after pushing moves on the board.
 #   (We only probe root moves in this file.)
@@ -37,6 +39,9 @@ _ALLOWED_PAWN_RANKS = (2, 3, 4)
 # Canonicalize left-right symmetry: only keep pawn files a..d (0..3).
 _CANON_PAWN_FILE_MAX = 3
 
+# Squares satisfying both constraints above.
+_PAWN_ZONE_MASK = mask_files(0, _CANON_PAWN_FILE_MAX) & mask_ranks(list(_ALLOWED_PAWN_RANKS))
+
 # Root "anti-triviality": exclude very short mate distances.
 _MIN_ABS_DTM_ROOT = 16
 
@@ -67,13 +72,6 @@ _BUCKET_DENOM_LOSS = 1
 # Small utilities
 # =============================================================================
 
-def _cheb(a: int, b: int) -> int:
-    """Chebyshev distance between squares a and b."""
-    af, ar = chess.square_file(a), chess.square_rank(a)
-    bf, br = chess.square_file(b), chess.square_rank(b)
-    return max(abs(af - bf), abs(ar - br))
-
-
 def _board_u64_key(board: chess.Board) -> int:
     """
     Stable-ish key across runs. Prefer zobrist/transposition when available,
@@ -129,14 +127,16 @@ def _bucket_id(board: chess.Board) -> int:
     """
     wk = board.king(chess.WHITE)
     bk = board.king(chess.BLACK)
-    p = next(iter(board.pieces(chess.PAWN, chess.BLACK)))
+    p_bb = board.pawns & board.occupied_co[chess.BLACK]
+    assert p_bb
+    p = _lsb(p_bb)
 
-    pf, pr = chess.square_file(p), chess.square_rank(p)
-    wkf, wkr = chess.square_file(wk), chess.square_rank(wk)
-    bkf, bkr = chess.square_file(bk), chess.square_rank(bk)
+    pf, pr = p & 7, p >> 3
+    wkf, wkr = wk & 7, wk >> 3
+    bkr = bk >> 3
 
-    d_wk = max(abs(wkf - pf), abs(wkr - pr))
-    d_bk = max(abs(bkf - pf), abs(bkr - pr))
+    d_wk = CHEB[(wk << 6) | p]
+    d_bk = CHEB[(bk << 6) | p]
 
     wk_rel = (wkr - pr) + 7  # shift to 0..14
     bk_rel = (bkr - pr) + 7
@@ -144,8 +144,8 @@ def _bucket_id(board: chess.Board) -> int:
     # "Opposition-ish" feature: same file and within 2 ranks.
     opp = 1 if (wkf == pf and abs(wkr - pr) <= 2) else 0
 
-    rook_pawn = 1 if pf in (0, 7) else 0
-    edge_pawn = 1 if pf in (0, 1, 6, 7) else 0
+    rook_pawn = 1 if (1 << pf) & 0b10000001 else 0  # files a, h
+    edge_pawn = 1 if (1 << pf) & 0b11000011 else 0  # files a, b, g, h
 
     # pack into an int (small ranges)
     out = 0
@@ -172,7 +172,7 @@ def _thin_by_bucket(board: chess.Board, denom: int, salt: int) -> bool:
 
 def _move_toward_pawn(move: chess.Move, pawn_sq: int, d_before: int) -> bool:
     """Return True if the king move does not increase Chebyshev distance to the pawn."""
-    d_after = _cheb(move.to_square, pawn_sq)
+    d_after = CHEB[(move.to_square << 6) | pawn_sq]
     return d_after <= d_before
 
 
@@ -190,7 +190,7 @@ def gen_hints_k_vs_kp() -> Mapping[str, Any]:
     """
     return {
         "piece_masks": {
-            (False, chess.PAWN): mask_files(0, _CANON_PAWN_FILE_MAX) & mask_ranks(list(_ALLOWED_PAWN_RANKS)),
+            (False, chess.PAWN): _PAWN_ZONE_MASK,
         },
     }
 
@@ -199,6 +199,43 @@ def gen_hints_k_vs_kp() -> Mapping[str, Any]:
 # Filters
 # =============================================================================
 
+@lru_cache(maxsize=1 << 20)
+def filter_notb_squares_k_vs_kp(wk: int, bk: int, p: int) -> bool:
+    """
+    Geometric part of filter_notb_k_vs_kp, on square indices only.
+    """
+    # Allowed pawn ranks and canonical files, folded into one square mask.
+    if not _PAWN_ZONE_MASK & (1 << p):
+        return False
+
+    # Interaction zone distances.
+    d_wk_p = CHEB[(wk << 6) | p]
+    d_bk_p = CHEB[(bk << 6) | p]
+
+    if d_wk_p < 2:
+        return False
+    if d_wk_p > 3:
+        return False
+
+    if d_bk_p > 3:
+        return False
+
+    # Avoid "kings too far": these become timing-only races.
+    if CHEB[(wk << 6) | bk] > 5:
+        return False
+
+    return True
+
+
+def filter_notb_placement_k_vs_kp(wk: int, bk: int, pieces: Sequence[Tuple[bool, int, Tuple[int, ...]]]) -> bool:
+    """
+    filter_notb_squares_k_vs_kp on a generator placement, before any Board is built.
+    pieces is in generation group order: black pawn.
+    """
+    (_, _, (p,)), = pieces
+    return filter_notb_squares_k_vs_kp(wk, bk, p)
+
+
 def filter_notb_k_vs_kp(board: chess.Board) -> bool:
     """
     K vs KP no-TB specific filter (White to move).
@@ -215,43 +252,28 @@ def filter_notb_k_vs_kp(board: chess.Board) -> bool:
       - Black king is also relevant: Chebyshev distance <= 3.
       - Kings are not extremely far from each other (keeps interaction).
     """
-    wk = board.king(chess.WHITE)
-    bk = board.king(chess.BLACK)
-
-    try:
-        p = next(iter(board.pieces(chess.PAWN, chess.BLACK)))
-    except StopIteration:
-        return False
-
-    pf, pr = chess.square_file(p), chess.square_rank(p)
-    if pr not in _ALLOWED_PAWN_RANKS:
-        return False
-    if pf > _CANON_PAWN_FILE_MAX:
-        return False
-
-    # Interaction zone distances.
-    d_wk_p = _cheb(wk, p)
-    d_bk_p = _cheb(bk, p)
-
-    if d_wk_p < 2:
-        return False
-    if d_wk_p > 3:
-        return False
-
-    if d_bk_p > 3:
+    white = board.occupied_co[chess.WHITE]
+    black = board.occupied_co[chess.BLACK]
+    p_bb = board.pawns & black
+    if not p_bb:
         return False
-
-    # Avoid "kings too far": these become timing-only races.
-    if _cheb(wk, bk) > 5:
+    wk_bb = board.kings & white
+    bk_bb = board.kings & black
+    assert wk_bb and bk_bb
+    if not filter_notb_squares_k_vs_kp(
+        _lsb(wk_bb),
+        _lsb(bk_bb),
+        _lsb(p_bb),
+    ):
         return False
 
     # Basic stability.
-    if board.is_check():
+    if board.checkers_mask():
         return False
 
     # Must have some choice (generic filter already ensures >=2 legal moves,
     # but here we enforce >=3 to avoid degenerate zugzwang-only corners).
-    if sum(1 for _ in board.legal_moves) < 3:
+    if sum(1 for _ in islice(board.generate_legal_moves(), 3)) < 3:
         return False
 
     return True
@@ -294,11 +316,20 @@ def filter_tb_k_vs_kp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
     if dtm is not None and abs(dtm) < _MIN_ABS_DTM_ROOT:
         return False
 
+    # Loss DTM window, checked before any move generation or probing.
+    if wdl < 0:
+        if dtm is None:
+            return False
+        if abs(dtm) < _MIN_ABS_DTM_LOSS or abs(dtm) > _MAX_ABS_DTM_LOSS:
+            return False
+
     wk = board.king(chess.WHITE)
-    p = next(iter(board.pieces(chess.PAWN, chess.BLACK)))
-    d_before = _cheb(wk, p)
+    p_bb = board.pawns & board.occupied_co[chess.BLACK]
+    assert p_bb
+    p = _lsb(p_bb)
+    d_before = CHEB[(wk << 6) | p]
 
-    legal_moves = list(board.legal_moves)
+    legal_moves = tb["legal_moves"]()
     if len(legal_moves) < 2:
         return False
 
@@ -308,8 +339,8 @@ def filter_tb_k_vs_kp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
 
     for mv in legal_moves:
         res = tb["probe_move"](mv)
-        m_wdl = int(res["wdl"])
-        m_dtm = res.get("dtm", None)
+        m_wdl = int(res.wdl)
+        m_dtm = res.dtm
 
         if m_wdl == 0:
             draws.append(mv)
@@ -365,11 +396,6 @@ def filter_tb_k_vs_kp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
     # LOSS branch
     # ----------------------------
     if wdl < 0:
-        if dtm is None:
-            return False
-        if abs(dtm) < _MIN_ABS_DTM_LOSS or abs(dtm) > _MAX_ABS_DTM_LOSS:
-            return False
-
         # Must be a pure loss: no drawing root move (otherwise root would be draw).
         if len(draws) != 0:
             return False
@@ -2,79 +2,95 @@
 
 from __future__ import annotations
 
-from typing import Any, Mapping
+from functools import lru_cache
+from typing import Any, Mapping, Sequence, Tuple
 
 import chess
 
-from helpers import mask_files, mask_ranks
+from helpers import CHEB, _lsb, mask_files, mask_ranks
 
 
-def filter_notb_kbp_vs_kb(board: chess.Board) -> bool:
+@lru_cache(maxsize=1 << 20)
+def filter_notb_squares_kbp_vs_kb(wk: int, bk: int, wb: int, wp: int, bb: int) -> bool:
     """
-    KBP (White) vs KB (Black) no-TB filter.
+    Geometric part of filter_notb_kbp_vs_kb, on square indices only.
     """
-    wk = board.king(chess.WHITE)
-    bk = board.king(chess.BLACK)
-
-    try:
-        wp = next(iter(board.pieces(chess.PAWN, chess.WHITE)))
-        wb = next(iter(board.pieces(chess.BISHOP, chess.WHITE)))
-        bb = next(iter(board.pieces(chess.BISHOP, chess.BLACK)))
-    except StopIteration:
-        return False
-
     # Bishops must be on the same color squares.
-    if (chess.square_file(wb) + chess.square_rank(wb)) % 2 != (
-        chess.square_file(bb) + chess.square_rank(bb)
-    ) % 2:
+    # Square color is the parity of file + rank, i.e. bit 0 of sq ^ (sq >> 3).
+    if (wb ^ (wb >> 3) ^ bb ^ (bb >> 3)) & 1:
         return False
 
-    pf, pr = chess.square_file(wp), chess.square_rank(wp)
+    pf, pr = wp & 7, wp >> 3
 
     # White pawn: files b-g, ranks 5/6 (0-based 4/5).
     if pf < 1 or pf > 6:
         return False
-    if pr not in (4, 5):
+    if not (1 << pr) & 0b00110000:  # ranks 4, 5
         return False
 
     # Combat zone distances.
-    wkf, wkr = chess.square_file(wk), chess.square_rank(wk)
-    bkf, bkr = chess.square_file(bk), chess.square_rank(bk)
-    if max(abs(wkf - pf), abs(wkr - pr)) > 2:
+    if CHEB[(wk << 6) | wp] > 2:
         return False
-    if max(abs(bkf - pf), abs(bkr - pr)) > 4:
+    if CHEB[(bk << 6) | wp] > 4:
         return False
 
     # Exclude if Black king blocks the promotion square and the bishop is the wrong color.
     promo_sq = chess.square(pf, 7)
     if bk == promo_sq:
-        promo_color = (chess.square_file(promo_sq) + chess.square_rank(promo_sq)) % 2
-        wb_color = (chess.square_file(wb) + chess.square_rank(wb)) % 2
-        if promo_color != wb_color:
+        if (promo_sq ^ (promo_sq >> 3) ^ wb ^ (wb >> 3)) & 1:
             return False
 
+    return True
+
+
+def filter_notb_placement_kbp_vs_kb(wk: int, bk: int, pieces: Sequence[Tuple[bool, int, Tuple[int, ...]]]) -> bool:
+    """
+    filter_notb_squares_kbp_vs_kb on a generator placement, before any Board is built.
+    pieces is in generation group order: white bishop, white pawn, black bishop.
+    """
+    (_, _, (wb,)), (_, _, (wp,)), (_, _, (bb,)) = pieces
+    return filter_notb_squares_kbp_vs_kb(wk, bk, wb, wp, bb)
+
+
+def filter_notb_kbp_vs_kb(board: chess.Board) -> bool:
+    """
+    KBP (White) vs KB (Black) no-TB filter.
+    """
+    wk = board.king(chess.WHITE)
+    bk = board.king(chess.BLACK)
+
+    wp_bb = board.pawns & board.occupied_co[chess.WHITE]
+    wb_bb = board.bishops & board.occupied_co[chess.WHITE]
+    bb_bb = board.bishops & board.occupied_co[chess.BLACK]
+    if not wp_bb or not wb_bb or not bb_bb:
+        return False
+    wp = _lsb(wp_bb)
+    wb = _lsb(wb_bb)
+    bb = _lsb(bb_bb)
+
+    if not filter_notb_squares_kbp_vs_kb(wk, bk, wb, wp, bb):
+        return False
+
     # Stability: no check on the white king, no immediate capture.
-    if board.is_check():
+    if board.checkers_mask():
+        return False
+    if next(board.generate_legal_captures(), None) is not None:
         return False
-    for mv in board.legal_moves:
-        if board.is_capture(mv):
-            return False
 
     # White bishop must not be en prise.
-    if board.attackers(chess.BLACK, wb):
+    if board.is_attacked_by(chess.BLACK, wb):
         return False
 
     # Exclude if White bishop can capture the Black bishop while the Black king
     # neither protects the bishop nor attacks the White pawn.
-    if (board.attacks(wb) >> bb) & 1:
-        bk_attacks = board.attacks(bk)
-        if not ((bk_attacks >> bb) & 1) and not ((bk_attacks >> wp) & 1):
+    if board.attacks_mask(wb) & chess.BB_SQUARES[bb]:
+        if not chess.BB_KING_ATTACKS[bk] & (chess.BB_SQUARES[bb] | chess.BB_SQUARES[wp]):
             return False
 
     # Exclude if the White king is on the Black bishop diagonal and the pawn is pinned.
-    if (board.attacks(bb) >> wp) & 1:
-        bbf, bbr = chess.square_file(bb), chess.square_rank(bb)
-        wkf, wkr = chess.square_file(wk), chess.square_rank(wk)
+    if board.attacks_mask(bb) & chess.BB_SQUARES[wp]:
+        bbf, bbr = bb & 7, bb >> 3
+        wkf, wkr = wk & 7, wk >> 3
         if abs(wkf - bbf) == abs(wkr - bbr):
             df = 1 if wkf > bbf else -1
             dr = 1 if wkr > bbr else -1
@@ -102,17 +118,20 @@ def filter_tb_kbp_vs_kb(board: chess.Board, tb: Mapping[str, Any]) -> bool:
     """
     KBP (White) vs KB (Black) TB filter.
     """
+    wdl = tb["wdl"]
+    if wdl < 0:
+        return False
+
     dtm = tb["dtm"]
     if dtm is not None and abs(dtm) < 11:
         return False
 
-    wdl = tb["wdl"]
-
     # A. Win: exactly one winning move.
     if wdl > 0:
+        probe_move_wdl = tb["probe_move_wdl"]
         winning = 0
-        for move in board.legal_moves:
-            if tb["probe_move"](move)["wdl"] == 1:
+        for move in board.generate_legal_moves():
+            if probe_move_wdl(move) == 1:
                 winning += 1
                 if winning > 1:
                     return False
@@ -136,11 +155,13 @@ def filter_tb_kbp_vs_kb(board: chess.Board, tb: Mapping[str, Any]) -> bool:
         if key & 1 == 0:
             return False
 
-        wp = next(iter(board.pieces(chess.PAWN, chess.WHITE)))
+        wp_bb = board.pawns & board.occupied_co[chess.WHITE]
+        assert wp_bb
+        wp = _lsb(wp_bb)
         wk = board.king(chess.WHITE)
         bk = board.king(chess.BLACK)
 
-        if chess.square_rank(wk) < chess.square_rank(wp):
+        if (wk >> 3) < (wp >> 3):
             return False
 
         pawn_front = wp + 8
@@ -4,11 +4,12 @@
 from __future__ import annotations
 
 import hashlib
-from typing import Any, Mapping, Optional
+from functools import lru_cache
+from typing import Any, Mapping, Optional, Sequence, Tuple
 
 import chess
 
-from helpers import mask_files, mask_ranks
+from helpers import CHEB, _lsb, mask_files, mask_ranks
 
 
 # =============================================================================
@@ -31,7 +32,7 @@ from helpers import mask_files, mask_ranks
 # Notes / constraints:
 # - The TB helper `tb["probe_move"]` is safe ONLY when used on the root board state.
 #   Do NOT push moves in this filter and then call probe_move() on the mutated board.
-#   In generate_positions.py, probe_move() caches by move.uci() only.
+#   In generate_positions.py, probe_move() caches by move only.
 # =============================================================================
 
 
@@ -39,18 +40,6 @@ from helpers import mask_files, mask_ranks
 # Small utilities
 # ----------------------------
 
-def _cheb_dist(a: int, b: int) -> int:
-    af, ar = a & 7, a >> 3
-    bf, br = b & 7, b >> 3
-    df = af - bf
-    dr = ar - br
-    if df < 0:
-        df = -df
-    if dr < 0:
-        dr = -dr
-    return df if df > dr else dr
-
-
 def _stable_u32(board: chess.Board) -> int:
     """
     Deterministic per-position 32-bit hash for sampling/thinning.
@@ -157,27 +146,12 @@ def gen_hints_kp_vs_k() -> Mapping[str, Any]:
 # Stage A: no-tablebase filter
 # =============================================================================
 
-def filter_notb_kp_vs_k(board: chess.Board) -> bool:
+@lru_cache(maxsize=1 << 20)
+def filter_notb_squares_kp_vs_k(wk: int, bk: int, p: int) -> bool:
     """
-    KP vs K no-TB filter (White to move).
-
-    We want positions that are plausibly non-trivial, so we enforce:
-    - Pawn somewhat advanced (rank 3..6 is already hinted, but keep a hard guard).
-    - Kings not too far from the pawn (interaction).
-    - Black king inside (or very close to) the pawn square to avoid "free queening".
-    - Avoid the ultra-trivial "pawn on 7th and not blocked" (usually one-move promotion).
+    Geometric part of filter_notb_kp_vs_k, on square indices only.
     """
-    try:
-        p = next(iter(board.pieces(chess.PAWN, chess.WHITE)))
-    except StopIteration:
-        return False
-
-    wk = board.king(chess.WHITE)
-    bk = board.king(chess.BLACK)
-    if wk is None or bk is None:
-        return False
-
-    pf, pr = chess.square_file(p), chess.square_rank(p)
+    pf, pr = p & 7, p >> 3
 
     # Hard guard: keep pawn advanced only.
     if pr < 3 or pr > 6:
@@ -189,38 +163,72 @@ def filter_notb_kp_vs_k(board: chess.Board) -> bool:
             return False
 
     # Interaction: both kings should be relevant.
-    d_wk_p = _cheb_dist(wk, p)
-    d_bk_p = _cheb_dist(bk, p)
-    if d_wk_p > 3:
+    if CHEB[(wk << 6) | p] > 3:
         return False
-    if d_bk_p > 4:
+    if CHEB[(bk << 6) | p] > 4:
+        return False
+
+    # Pawn square heuristic.
+    moves_to_promote = 7 - pr
+    promo_sq = _pawn_promo_sq(pf)
+    if CHEB[(bk << 6) | promo_sq] > (moves_to_promote + 1):
+        return False
+
+    # Also keep WK not totally off the pawn file when pawn is still far.
+    if pr <= 4 and abs((wk & 7) - pf) >= 3:
+        return False
+
+    return True
+
+
+def filter_notb_placement_kp_vs_k(wk: int, bk: int, pieces: Sequence[Tuple[bool, int, Tuple[int, ...]]]) -> bool:
+    """
+    filter_notb_squares_kp_vs_k on a generator placement, before any Board is built.
+    pieces is in generation group order: white pawn.
+    """
+    (_, _, (p,)), = pieces
+    return filter_notb_squares_kp_vs_k(wk, bk, p)
+
+
+def filter_notb_kp_vs_k(board: chess.Board) -> bool:
+    """
+    KP vs K no-TB filter (White to move).
+
+    We want positions that are plausibly non-trivial, so we enforce:
+    - Pawn somewhat advanced (rank 3..6 is already hinted, but keep a hard guard).
+    - Kings not too far from the pawn (interaction).
+    - Black king inside (or very close to) the pawn square to avoid "free queening".
+    - Avoid the ultra-trivial "pawn on 7th and not blocked" (usually one-move promotion).
+    """
+    white = board.occupied_co[chess.WHITE]
+    black = board.occupied_co[chess.BLACK]
+    p_bb = board.pawns & white
+    wk_bb = board.kings & white
+    bk_bb = board.kings & black
+    if not p_bb or not wk_bb or not bk_bb:
+        return False
+    p = _lsb(p_bb)
+    wk = _lsb(wk_bb)
+    bk = _lsb(bk_bb)
+
+    if not filter_notb_squares_kp_vs_k(wk, bk, p):
         return False
 
     # Avoid positions where Black attacks the pawn and White cannot protect it or move it to safety.
-    if d_bk_p == 1:
+    if CHEB[(bk << 6) | p] == 1:
         can_save = False
         for move in board.legal_moves:
             if move.from_square == p:
-                if _cheb_dist(bk, move.to_square) > 1 or _cheb_dist(wk, move.to_square) == 1:
+                if CHEB[(bk << 6) | move.to_square] > 1 or CHEB[(wk << 6) | move.to_square] == 1:
                     can_save = True
                     break
             elif move.from_square == wk:
-                if _cheb_dist(move.to_square, p) == 1:
+                if CHEB[(move.to_square << 6) | p] == 1:
                     can_save = True
                     break
         if not can_save:
             return False
 
-    # Pawn square heuristic.
-    moves_to_promote = 7 - pr
-    promo_sq = _pawn_promo_sq(pf)
-    if _cheb_dist(bk, promo_sq) > (moves_to_promote + 1):
-        return False
-
-    # Also keep WK not totally off the pawn file when pawn is still far.
-    if pr <= 4 and abs((wk & 7) - pf) >= 3:
-        return False
-
     return True
 
 
@@ -251,21 +259,25 @@ def filter_tb_kp_vs_k(board: chess.Board, tb: Mapping[str, Any]) -> bool:
     wdl = tb["wdl"]
     dtm = tb["dtm"]
 
-    try:
-        p = next(iter(board.pieces(chess.PAWN, chess.WHITE)))
-    except StopIteration:
+    # Cheapest selective gates first: outcome and (for wins) DTM window.
+    if wdl not in (0, 1):
+        return False
+    # Remove "instant wins" and very long shuffles.
+    if wdl == 1 and (dtm is None or dtm < 16 or dtm > 180):
+        return False
+
+    p_bb = board.pawns & board.occupied_co[chess.WHITE]
+    if not p_bb:
         return False
+    p = _lsb(p_bb)
     wk = board.king(chess.WHITE)
     bk = board.king(chess.BLACK)
     if wk is None or bk is None:
         return False
 
-    pf, pr = chess.square_file(p), chess.square_rank(p)
-
-    if wdl not in (0, 1):
-        return False
+    pf, pr = p & 7, p >> 3
 
-    legal_moves = list(board.legal_moves)
+    legal_moves = tb["legal_moves"]()
     if len(legal_moves) < 2:
         return False
 
@@ -273,21 +285,13 @@ def filter_tb_kp_vs_k(board: chess.Board, tb: Mapping[str, Any]) -> bool:
     # WIN case
     # -------------------------------------------------------------------------
     if wdl == 1:
-        # DTM sanity window: remove "instant wins" and very long shuffles.
-        if dtm is None:
-            return False
-        if dtm < 16:
-            return False
-        if dtm > 180:
-            return False
-
         winning_moves = []
         drawing_moves = []
 
         for mv in legal_moves:
             res = tb["probe_move"](mv)
-            if res["wdl"] == 1:
-                winning_moves.append((mv, res["dtm"]))
+            if res.wdl == 1:
+                winning_moves.append((mv, res.dtm))
             else:
                 drawing_moves.append(mv)
 
@@ -342,8 +346,8 @@ def filter_tb_kp_vs_k(board: chess.Board, tb: Mapping[str, Any]) -> bool:
         if pr < 3:
             return False
 
-        d_wk_p = _cheb_dist(wk, p)
-        d_bk_p = _cheb_dist(bk, p)
+        d_wk_p = CHEB[(wk << 6) | p]
+        d_bk_p = CHEB[(bk << 6) | p]
 
         if d_wk_p > 2:
             return False
@@ -353,16 +357,16 @@ def filter_tb_kp_vs_k(board: chess.Board, tb: Mapping[str, Any]) -> bool:
         pawn_front = _pawn_front_sq(p)
         promo_sq = _pawn_promo_sq(pf)
 
-        in_front_same_file = (chess.square_file(bk) == pf and chess.square_rank(bk) > pr)
+        in_front_same_file = ((bk & 7) == pf and (bk >> 3) > pr)
 
         # Primary block zone: BK blocks or is clearly in front.
         if bk != pawn_front and bk != promo_sq and not in_front_same_file:
             # Secondary: BK adjacent to the front square (common "shouldering" draws).
-            if chess.square_distance(bk, pawn_front) > 1:
+            if CHEB[(bk << 6) | pawn_front] > 1:
                 return False
 
         # Make it feel "almost winning": WK should be at/above pawn rank.
-        if chess.square_rank(wk) < pr:
+        if (wk >> 3) < pr:
             return False
 
         # pr==3 draws are only accepted if BK is directly blocking and kings are very tight.
@@ -375,7 +379,7 @@ def filter_tb_kp_vs_k(board: chess.Board, tb: Mapping[str, Any]) -> bool:
         # Rook pawn special-case: encourage corner motif.
         if _is_rook_pawn(pf):
             corner = chess.A8 if pf == 0 else chess.H8
-            if _cheb_dist(bk, corner) > 2:
+            if CHEB[(bk << 6) | corner] > 2:
                 return False
 
         # Prefer positions where White has limited king moves (zugzwang-ish), but allow a bit more.
@@ -3,11 +3,12 @@
 
 from __future__ import annotations
 
-from typing import Any, Mapping, Optional, List, Tuple
+from functools import lru_cache
+from typing import Any, Mapping, Optional, List, Sequence, Tuple
 
 import chess
 
-from helpers import mask_files
+from helpers import CHEB, _lsb, mask_files
 
 # =============================================================================
 # Generation hints
@@ -79,8 +80,12 @@ def _is_lr_canonical(board: chess.Board) -> bool:
     Compare tuples (wp, bp, wk, bk) with their mirrored version and keep the
     lexicographically smallest.
     """
-    wp = next(iter(board.pieces(chess.PAWN, chess.WHITE)))
-    bp = next(iter(board.pieces(chess.PAWN, chess.BLACK)))
+    wp_bb = board.pawns & board.occupied_co[chess.WHITE]
+    assert wp_bb
+    wp = _lsb(wp_bb)
+    bp_bb = board.pawns & board.occupied_co[chess.BLACK]
+    assert bp_bb
+    bp = _lsb(bp_bb)
     wk = board.king(chess.WHITE)
     bk = board.king(chess.BLACK)
 
@@ -93,23 +98,31 @@ def _is_lr_canonical(board: chess.Board) -> bool:
 # Theme classifier + coarse diversity bucketing
 # =============================================================================
 
+# Pawn contact masks, per pawn square: same-file neighbours (locked pawns) and
+# diagonal neighbours (capture contact), so contact tests are one AND.
+_FILE_CONTACT = [chess.BB_KING_ATTACKS[s] & chess.BB_FILES[s & 7] for s in range(64)]
+_DIAG_CONTACT = [
+    chess.BB_KING_ATTACKS[s] & ~chess.BB_FILES[s & 7] & ~chess.BB_RANKS[s >> 3] for s in range(64)
+]
+
 # Theme id:
 # 0: locked same-file pawns (adjacent)
 # 1: diagonal pawn contact (capture motif)
 # 2: adjacent files (no immediate contact)
 # 3: separated files (>=2)
 def _classify_theme(board: chess.Board) -> int:
-    wp = next(iter(board.pieces(chess.PAWN, chess.WHITE)))
-    bp = next(iter(board.pieces(chess.PAWN, chess.BLACK)))
-    wpf, wpr = chess.square_file(wp), chess.square_rank(wp)
-    bpf, bpr = chess.square_file(bp), chess.square_rank(bp)
-
-    fd = abs(wpf - bpf)
-    if wpf == bpf and abs(wpr - bpr) == 1:
+    wp_bb = board.pawns & board.occupied_co[chess.WHITE]
+    assert wp_bb
+    wp = _lsb(wp_bb)
+    bp_bb = board.pawns & board.occupied_co[chess.BLACK]
+    assert bp_bb
+    bp = _lsb(bp_bb)
+
+    if _FILE_CONTACT[wp] & bp_bb:
         return 0
-    if fd == 1 and abs(wpr - bpr) == 1:
+    if _DIAG_CONTACT[wp] & bp_bb:
         return 1
-    if fd == 1:
+    if abs((wp & 7) - (bp & 7)) == 1:
         return 2
     return 3
 
@@ -121,13 +134,17 @@ def _bucket_salt(board: chess.Board, wdl: int) -> int:
     IMPORTANT: keep this bucket coarse so that near-duplicates collide and only
     a fraction is kept, improving variety.
     """
-    wp = next(iter(board.pieces(chess.PAWN, chess.WHITE)))
-    bp = next(iter(board.pieces(chess.PAWN, chess.BLACK)))
+    wp_bb = board.pawns & board.occupied_co[chess.WHITE]
+    assert wp_bb
+    wp = _lsb(wp_bb)
+    bp_bb = board.pawns & board.occupied_co[chess.BLACK]
+    assert bp_bb
+    bp = _lsb(bp_bb)
     wk = board.king(chess.WHITE)
     bk = board.king(chess.BLACK)
 
-    wpf, wpr = chess.square_file(wp), chess.square_rank(wp)
-    bpf, bpr = chess.square_file(bp), chess.square_rank(bp)
+    wpf, wpr = wp & 7, wp >> 3
+    bpf, bpr = bp & 7, bp >> 3
 
     theme = _classify_theme(board)
     file_diff = abs(wpf - bpf)
@@ -146,11 +163,11 @@ def _bucket_salt(board: chess.Board, wdl: int) -> int:
             return 1
         return 2
 
-    dkw = dbin(chess.square_distance(wk, wp))
-    dkb = dbin(chess.square_distance(wk, bp))
-    dbw = dbin(chess.square_distance(bk, wp))
-    dbb = dbin(chess.square_distance(bk, bp))
-    dkk = dbin(chess.square_distance(wk, bk))
+    dkw = dbin(CHEB[(wk << 6) | wp])
+    dkb = dbin(CHEB[(wk << 6) | bp])
+    dbw = dbin(CHEB[(bk << 6) | wp])
+    dbb = dbin(CHEB[(bk << 6) | bp])
+    dkk = dbin(CHEB[(wk << 6) | bk])
 
     wdl_i = {-1: 0, 0: 1, 1: 2}[int(wdl)]
 
@@ -183,6 +200,49 @@ _PRE_TB_SAMPLE_P = 0.03
 _PRE_TB_SAMPLE_P_LOSSLIKE = 0.10
 
 
+@lru_cache(maxsize=1 << 20)
+def filter_notb_squares_kp_vs_kp(wk: int, bk: int, wp: int, bp: int) -> bool:
+    """
+    Geometric part of filter_notb_kp_vs_kp, on square indices only.
+    """
+    # Left-right symmetry: keep the lexicographically smallest of (wp, bp, wk, bk) and its mirror.
+    if (wp, bp, wk, bk) > (_mirror_sq_lr(wp), _mirror_sq_lr(bp), _mirror_sq_lr(wk), _mirror_sq_lr(bk)):
+        return False
+
+    # Keep pawns in human ranks 3..6 (0-based 2..5)
+    if not (2 <= (wp >> 3) <= 5):
+        return False
+    if not (2 <= (bp >> 3) <= 5):
+        return False
+
+    # Kings must be relevant (avoid pure races).
+    d_wk_wp = CHEB[(wk << 6) | wp]
+    d_wk_bp = CHEB[(wk << 6) | bp]
+    d_bk_wp = CHEB[(bk << 6) | wp]
+    d_bk_bp = CHEB[(bk << 6) | bp]
+
+    if min(d_wk_wp, d_wk_bp) > 4:
+        return False
+    if min(d_bk_wp, d_bk_bp) > 4:
+        return False
+
+    # Separated files without pawn contact: kings must still be close to the action.
+    if abs((wp & 7) - (bp & 7)) >= 2:
+        if CHEB[(wk << 6) | bk] > 5 and min(d_wk_bp, d_bk_wp) > 4:
+            return False
+
+    return True
+
+
+def filter_notb_placement_kp_vs_kp(wk: int, bk: int, pieces: Sequence[Tuple[bool, int, Tuple[int, ...]]]) -> bool:
+    """
+    filter_notb_squares_kp_vs_kp on a generator placement, before any Board is built.
+    pieces is in generation group order: white pawn, black pawn.
+    """
+    (_, _, (wp,)), (_, _, (bp,)) = pieces
+    return filter_notb_squares_kp_vs_kp(wk, bk, wp, bp)
+
+
 def filter_notb_kp_vs_kp(board: chess.Board) -> bool:
     """
     KP vs KP no-TB filter (White to move).
@@ -195,53 +255,37 @@ def filter_notb_kp_vs_kp(board: chess.Board) -> bool:
     """
     if board.turn != chess.WHITE:
         return False
-    if not _is_lr_canonical(board):
-        return False
-    if board.is_check():
-        return False
 
-    wp = next(iter(board.pieces(chess.PAWN, chess.WHITE)))
-    bp = next(iter(board.pieces(chess.PAWN, chess.BLACK)))
+    wp_bb = board.pawns & board.occupied_co[chess.WHITE]
+    assert wp_bb
+    wp = _lsb(wp_bb)
+    bp_bb = board.pawns & board.occupied_co[chess.BLACK]
+    assert bp_bb
+    bp = _lsb(bp_bb)
     wk = board.king(chess.WHITE)
     bk = board.king(chess.BLACK)
 
-    wpr = chess.square_rank(wp)
-    bpr = chess.square_rank(bp)
-    wpf = chess.square_file(wp)
-    bpf = chess.square_file(bp)
-
-    # Keep pawns in human ranks 3..6 (0-based 2..5)
-    if not (2 <= wpr <= 5):
+    if not filter_notb_squares_kp_vs_kp(wk, bk, wp, bp):
         return False
-    if not (2 <= bpr <= 5):
+    if board.checkers_mask():
         return False
 
-    file_diff = abs(wpf - bpf)
-    locked_same_file = (wpf == bpf and abs(wpr - bpr) == 1)
-    diagonal_contact = (file_diff == 1 and abs(wpr - bpr) == 1)
-
-    # Kings must be relevant (avoid pure races).
-    d_wk_wp = chess.square_distance(wk, wp)
-    d_wk_bp = chess.square_distance(wk, bp)
-    d_bk_wp = chess.square_distance(bk, wp)
-    d_bk_bp = chess.square_distance(bk, bp)
-
-    if min(d_wk_wp, d_wk_bp) > 4:
-        return False
-    if min(d_bk_wp, d_bk_bp) > 4:
-        return False
+    wpr = wp >> 3
+    bpr = bp >> 3
+    locked_same_file = bool(_FILE_CONTACT[wp] & bp_bb)
 
-    if file_diff >= 2 and not (locked_same_file or diagonal_contact):
-        if chess.square_distance(wk, bk) > 5 and min(d_wk_bp, d_bk_wp) > 4:
-            return False
+    d_wk_wp = CHEB[(wk << 6) | wp]
+    d_wk_bp = CHEB[(wk << 6) | bp]
+    d_bk_bp = CHEB[(bk << 6) | bp]
 
     # Require real branching + king mobility (single pass).
     n = 0
     king_moves = 0
     pawn_moves = 0
-    for mv in board.legal_moves:
+    piece_type_at = board.piece_type_at
+    for mv in board.generate_legal_moves():
         n += 1
-        pt = board.piece_type_at(mv.from_square)
+        pt = piece_type_at(mv.from_square)
         if pt == chess.KING:
             king_moves += 1
         elif pt == chess.PAWN:
@@ -337,7 +381,7 @@ def filter_tb_kp_vs_kp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
             if a < _MIN_LOSS_DTM or a > max_abs_dtm:
                 return False
 
-    moves = list(board.legal_moves)
+    moves = tb["legal_moves"]()
     if len(moves) < 6:
         return False
 
@@ -365,8 +409,8 @@ def filter_tb_kp_vs_kp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
 
     for mv in king_moves:
         res = tb["probe_move"](mv)
-        cw = int(res["wdl"])
-        cd0 = res["dtm"]
+        cw = int(res.wdl)
+        cd0 = res.dtm
         cd = None if cd0 is None else int(cd0)
         k_res.append((mv, cw, cd))
         if cw > 0:
@@ -387,7 +431,7 @@ def filter_tb_kp_vs_kp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
         for mv, cw, cd in k_res:
             if mv == best_mv:
                 continue
-            if chess.square_distance(mv.to_square, best_to) > 1:
+            if CHEB[(mv.to_square << 6) | best_to] > 1:
                 continue
             if cw <= 0:
                 if cw < 0:
@@ -416,8 +460,8 @@ def filter_tb_kp_vs_kp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
                 if cap_or_prom(mv):
                     continue
                 res = tb["probe_move"](mv)
-                if int(res["wdl"]) > 0:
-                    cd0 = res["dtm"]
+                if int(res.wdl) > 0:
+                    cd0 = res.dtm
                     cd = None if cd0 is None else int(cd0)
                     if best_mv is None:
                         best_mv, best_dtm = mv, cd
@@ -498,8 +542,8 @@ def filter_tb_kp_vs_kp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
             if cap_or_prom(mv):
                 continue
             res = tb["probe_move"](mv)
-            cw = int(res["wdl"])
-            cd0 = res["dtm"]
+            cw = int(res.wdl)
+            cd0 = res.dtm
             if cw >= 0:
                 # If any pawn move draws/wins, root wouldn't be losing; be conservative.
                 return False
@@ -545,7 +589,7 @@ def filter_tb_kp_vs_kp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
             for mv, d, pt in defenses_all[1:]:
                 if pt != chess.KING:
                     continue
-                if chess.square_distance(mv.to_square, best_mv.to_square) > 1:
+                if CHEB[(mv.to_square << 6) | best_mv.to_square] > 1:
                     continue
                 if (d - best_d) >= 12 and abs(d) >= _MIN_CHILD_ABS_LOSS_DTM:
                     local_bad += 1
@@ -1,17 +1,17 @@
 from __future__ import annotations
-from typing import Any, Mapping
+from functools import lru_cache
+from typing import Any, Mapping, Sequence, Tuple
 import chess
 
-def filter_notb_kp_vs_kr(board: chess.Board) -> bool:
+from helpers import CHEB, _lsb
+
+
+@lru_cache(maxsize=1 << 20)
+def filter_notb_squares_kp_vs_kr(wk: int, bk: int, p: int) -> bool:
     """
-    KP (White) vs KR (Black) - NO-TB Filter.
+    Geometric part of filter_notb_kp_vs_kr, on square indices only.
     """
-    p = next(iter(board.pieces(chess.PAWN, chess.WHITE)))
-    wk = board.king(chess.WHITE)
-    bk = board.king(chess.BLACK)
-    r = next(iter(board.pieces(chess.ROOK, chess.BLACK)))
-
-    pr, pf = chess.square_rank(p), chess.square_file(p)
+    pr, pf = p >> 3, p & 7
 
     # 1. Pawn Rank: Human Ranks 5, 6, 7 (Indices 4, 5, 6).
     # We still allow Rank 7 into the pipeline for the "Loss" scenario.
@@ -19,22 +19,49 @@ def filter_notb_kp_vs_kr(board: chess.Board) -> bool:
         return False 
 
     # 2. White King: Must be close (Distance <= 1).
-    wkf, wkr = chess.square_file(wk), chess.square_rank(wk)
-    if max(abs(wkf - pf), abs(wkr - pr)) > 1:
+    if CHEB[(wk << 6) | p] > 1:
         return False
 
     # 3. Black King: Reject if ON THE TRAJECTORY.
-    bkf, bkr = chess.square_file(bk), chess.square_rank(bk)
+    bkf, bkr = bk & 7, bk >> 3
     if bkf == pf and bkr > pr:
         return False
 
+    return True
+
+
+def filter_notb_placement_kp_vs_kr(wk: int, bk: int, pieces: Sequence[Tuple[bool, int, Tuple[int, ...]]]) -> bool:
+    """
+    filter_notb_squares_kp_vs_kr on a generator placement, before any Board is built.
+    pieces is in generation group order: white pawn, black rook.
+    """
+    (_, _, (p,)), _ = pieces
+    return filter_notb_squares_kp_vs_kr(wk, bk, p)
+
+
+def filter_notb_kp_vs_kr(board: chess.Board) -> bool:
+    """
+    KP (White) vs KR (Black) - NO-TB Filter.
+    """
+    white = board.occupied_co[chess.WHITE]
+    black = board.occupied_co[chess.BLACK]
+    p_bb = board.pawns & white
+    wk_bb = board.kings & white
+    bk_bb = board.kings & black
+    assert p_bb and wk_bb and bk_bb
+    p = _lsb(p_bb)
+    wk = _lsb(wk_bb)
+    bk = _lsb(bk_bb)
+
+    if not filter_notb_squares_kp_vs_kr(wk, bk, p):
+        return False
+
     # 4. Safety & Tactics
-    if board.is_check(): 
+    if board.checkers_mask(): 
         return False
 
-    for move in board.legal_moves:
-        if board.is_capture(move):
-            return False
+    if next(board.generate_legal_captures(), None) is not None:
+        return False
 
     return True
 
@@ -51,8 +78,10 @@ def filter_tb_kp_vs_kr(board: chess.Board, tb: Mapping[str, Any]) -> bool:
         return False
 
     # Get pawn rank once.
-    p = next(iter(board.pieces(chess.PAWN, chess.WHITE)))
-    pr = chess.square_rank(p)
+    p_bb = board.pawns & board.occupied_co[chess.WHITE]
+    assert p_bb
+    p = _lsb(p_bb)
+    pr = p >> 3
 
     # --- SCENARIO A: WHITE LOSES (Black Wins) ---
     if wdl < 0:
@@ -73,13 +102,14 @@ def filter_tb_kp_vs_kr(board: chess.Board, tb: Mapping[str, Any]) -> bool:
         drawing_moves = 0
         losing_moves = 0
         
-        for move in board.legal_moves:
-            res = tb["probe_move"](move)
-            if res["wdl"] == 0:
+        probe_move_wdl = tb["probe_move_wdl"]
+        for move in tb["legal_moves"]():
+            w = probe_move_wdl(move)
+            if w == 0:
                 drawing_moves += 1
                 if drawing_moves >= 2:
                     return False
-            elif res["wdl"] < 0:
+            elif w < 0:
                 losing_moves += 1
         
         # Danger required.
@@ -94,16 +124,7 @@ def filter_tb_kp_vs_kr(board: chess.Board, tb: Mapping[str, Any]) -> bool:
         if pr != 5:
             return False
 
-        winning_moves = 0
-        for move in board.legal_moves:
-            res = tb["probe_move"](move)
-            if res["wdl"] > 0:
-                winning_moves += 1
-        
         # Puzzle Logic: Only 1 winning move allowed.
-        if winning_moves == 1:
-            return True
-
-        return False
+        return tb["probe_wdls"]().count(1) == 1
 
     return False
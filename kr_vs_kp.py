@@ -2,68 +2,88 @@
 
 from __future__ import annotations
 
-from typing import Any, Mapping
+from functools import lru_cache
+from typing import Any, Mapping, Sequence, Tuple
 
 import chess
 
+from helpers import CHEB, _lsb
 
-def filter_notb_kr_vs_kp(board: chess.Board) -> bool:
-    """
-    KR vs KP no-TB specific filter (White to move):
 
-    Keep only positions where:
-    - Black pawn is on human rank 5/6/7 (0-based rank 4/5/6).
-    - White rook is not on the same rank/file as the black pawn.
-    - Black king protects its pawn: Chebyshev distance(bK, pawn) <= 1.
-    - White king is "late": Chebyshev distance(wK, pawn) > 2 and < 6.
-    - White rook is not attacked by the black king or the black pawn.
+@lru_cache(maxsize=1 << 20)
+def filter_notb_squares_kr_vs_kp(wk: int, bk: int, p: int, r: int) -> bool:
     """
-    p = next(iter(board.pieces(chess.PAWN, chess.BLACK)))
-    wk = board.king(chess.WHITE)
-    bk = board.king(chess.BLACK)
-    r = next(iter(board.pieces(chess.ROOK, chess.WHITE)))
-
-    pr = chess.square_rank(p)
-    pf = chess.square_file(p)
+    filter_notb_kr_vs_kp on square indices only (the filter is purely geometric).
+    """
+    pr = p >> 3
+    pf = p & 7
 
     # We want pawns on human rank 2/3/4 <=> 0-based rank in {1,2,3}
     if pr > 3:
         return False
 
-    rf = chess.square_file(r)
-    rr = chess.square_rank(r)
+    rf = r & 7
+    rr = r >> 3
 
     # Rook not on same file/rank as the pawn
     if rf == pf or rr == pr:
         return False
 
-    bkf, bkr = chess.square_file(bk), chess.square_rank(bk)
-
     # Black king protects the pawn (Chebyshev distance <= 1)
-    if max(abs(bkf - pf), abs(bkr - pr)) > 1:
+    if CHEB[(bk << 6) | p] > 1:
         return False
 
-    wkf, wkr = chess.square_file(wk), chess.square_rank(wk)
-
     # White king is "late": distance > 2 and < 6
-    d_wk_p = max(abs(wkf - pf), abs(wkr - pr))
+    d_wk_p = CHEB[(wk << 6) | p]
     if d_wk_p <= 2 or d_wk_p >= 6:
         return False
 
     # Rook is not attacked by black king
-    if max(abs(bkf - rf), abs(bkr - rr)) <= 1:
+    if CHEB[(bk << 6) | r] <= 1:
         return False
 
-    # Rook is not attacked by the black pawn.
-    # Black pawn captures diagonally "down" (towards rank decreasing): p-9 and p-7.
-    if pf > 0 and r == p - 9:
-        return False
-    if pf < 7 and r == p - 7:
+    # Rook is not attacked by the black pawn (the attack table handles the board edges).
+    if chess.BB_PAWN_ATTACKS[chess.BLACK][p] & chess.BB_SQUARES[r]:
         return False
 
     return True
 
 
+def filter_notb_placement_kr_vs_kp(wk: int, bk: int, pieces: Sequence[Tuple[bool, int, Tuple[int, ...]]]) -> bool:
+    """
+    filter_notb_squares_kr_vs_kp on a generator placement, before any Board is built.
+    pieces is in generation group order: white rook, black pawn.
+    """
+    (_, _, (r,)), (_, _, (p,)) = pieces
+    return filter_notb_squares_kr_vs_kp(wk, bk, p, r)
+
+
+def filter_notb_kr_vs_kp(board: chess.Board) -> bool:
+    """
+    KR vs KP no-TB specific filter (White to move):
+
+    Keep only positions where:
+    - Black pawn is on human rank 5/6/7 (0-based rank 4/5/6).
+    - White rook is not on the same rank/file as the black pawn.
+    - Black king protects its pawn: Chebyshev distance(bK, pawn) <= 1.
+    - White king is "late": Chebyshev distance(wK, pawn) > 2 and < 6.
+    - White rook is not attacked by the black king or the black pawn.
+    """
+    white = board.occupied_co[chess.WHITE]
+    black = board.occupied_co[chess.BLACK]
+    p_bb = board.pawns & black
+    r_bb = board.rooks & white
+    wk_bb = board.kings & white
+    bk_bb = board.kings & black
+    assert wk_bb and bk_bb and p_bb and r_bb
+    return filter_notb_squares_kr_vs_kp(
+        _lsb(wk_bb),
+        _lsb(bk_bb),
+        _lsb(p_bb),
+        _lsb(r_bb),
+    )
+
+
 def filter_tb_kr_vs_kp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
     """
     KR vs KP TB-specific filter (White POV outcomes):
@@ -79,53 +99,57 @@ def filter_tb_kr_vs_kp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
             (4) If drawing moves are rook moves: at most 4 drawing moves AND
                 all rook drawing moves go in the same direction (N/S/E/W).
     """
-    dtm = tb["dtm"]
-    if dtm is not None and abs(dtm) < 11:
-        return False
-
     wdl = tb["wdl"]
     if wdl < 0:
         return False
 
+    dtm = tb["dtm"]
+    if dtm is not None and abs(dtm) < 11:
+        return False
+
     if wdl > 0:
+        probe_move_wdl = tb["probe_move_wdl"]
         winning = 0
-        for move in board.legal_moves:
-            if tb["probe_move"](move)["wdl"] == 1:
+        for move in board.generate_legal_moves():
+            if probe_move_wdl(move) == 1:
                 winning += 1
                 if winning > 1:
                     return False
         return winning == 1
 
     # Draw case.
-    p = next(iter(board.pieces(chess.PAWN, chess.BLACK)))
-    wk = board.king(chess.WHITE)
-    bk = board.king(chess.BLACK)
-    r = next(iter(board.pieces(chess.ROOK, chess.WHITE)))
+    white = board.occupied_co[chess.WHITE]
+    black = board.occupied_co[chess.BLACK]
+    p_bb = board.pawns & black
+    assert p_bb
+    p = _lsb(p_bb)
 
-    pr = chess.square_rank(p)
-    pf = chess.square_file(p)
+    pr = p >> 3
 
     # Too easy draw
     if pr == 1:
         return False
 
-    rf = chess.square_file(r)
-    rr = chess.square_rank(r)
+    r_bb = board.rooks & white
+    wk_bb = board.kings & white
+    bk_bb = board.kings & black
+    assert r_bb and wk_bb and bk_bb
+    r = _lsb(r_bb)
+    wk = _lsb(wk_bb)
+    bk = _lsb(bk_bb)
 
-    bkf, bkr = chess.square_file(bk), chess.square_rank(bk)
+    bkr = bk >> 3
 
     # Black king protects the pawn but is not in front of it
     if bkr < pr:
         return False
 
-    wkf, wkr = chess.square_file(wk), chess.square_rank(wk)
-
     # White king is not that "late"
-    d_wk_p = max(abs(wkf - pf), abs(wkr - pr))
+    d_wk_p = CHEB[(wk << 6) | p]
     if d_wk_p >= 4:
         return False
     
-    d_r_p = max(abs(rf - pf), abs(rr - pr))        
+    d_r_p = CHEB[(r << 6) | p]
     if d_r_p > 4:
         return False       
 
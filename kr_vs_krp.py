@@ -3,12 +3,13 @@
 
 from __future__ import annotations
 
-from typing import Any, Mapping, Optional
+from typing import Any, Mapping, Optional, Sequence, Tuple
 import hashlib
+from functools import lru_cache
 
 import chess
 
-from helpers import mask_files, mask_ranks
+from helpers import CHEB, _lsb, mask_files, mask_ranks
 
 
 # =============================================================================
@@ -23,7 +24,7 @@ from helpers import mask_files, mask_ranks
 #   - Draws: very few drawing moves (<=2), and at least one sharp losing blunder.
 #   - Losses: non-trivial DTM, unique best defense, strong spread, and large blunders.
 #
-# NOTE: tb["probe_move"] in generate_positions.py caches by move.uci() only.
+# NOTE: tb["probe_move"] in generate_positions.py caches by move only.
 # It is safe only when used on the root board state (which we do here).
 # =============================================================================
 
@@ -33,6 +34,7 @@ from helpers import mask_files, mask_ranks
 # ----------------------------
 
 _ALLOWED_PAWN_RANKS = (2, 3, 4)  # 0-based ranks (human 3/4/5)
+_ALLOWED_PAWN_RANK_BITS = sum(1 << r for r in _ALLOWED_PAWN_RANKS)
 _CANON_PAWN_FILE_MIN = 1         # b
 _CANON_PAWN_FILE_MAX = 3         # d  (mirror-symmetry in b-g)
 
@@ -101,16 +103,22 @@ def _keep_with_prob(board: chess.Board, p: float, salt: int) -> bool:
 def _bucket_id(board: chess.Board) -> int:
     wk = board.king(chess.WHITE)
     bk = board.king(chess.BLACK)
-    bp = next(iter(board.pieces(chess.PAWN, chess.BLACK)))
-    wr = next(iter(board.pieces(chess.ROOK, chess.WHITE)))
-    br = next(iter(board.pieces(chess.ROOK, chess.BLACK)))
-
-    pf, pr = chess.square_file(bp), chess.square_rank(bp)
-    d_wk = chess.square_distance(wk, bp)
-    d_bk = chess.square_distance(bk, bp)
-
-    wrf, wrr = chess.square_file(wr), chess.square_rank(wr)
-    brf, brr = chess.square_file(br), chess.square_rank(br)
+    bp_bb = board.pawns & board.occupied_co[chess.BLACK]
+    assert bp_bb
+    bp = _lsb(bp_bb)
+    wr_bb = board.rooks & board.occupied_co[chess.WHITE]
+    assert wr_bb
+    wr = _lsb(wr_bb)
+    br_bb = board.rooks & board.occupied_co[chess.BLACK]
+    assert br_bb
+    br = _lsb(br_bb)
+
+    pf, pr = bp & 7, bp >> 3
+    d_wk = CHEB[(wk << 6) | bp]
+    d_bk = CHEB[(bk << 6) | bp]
+
+    wrf, wrr = wr & 7, wr >> 3
+    brf, brr = br & 7, br >> 3
 
     out = 0
     out |= (pf & 7)
@@ -136,44 +144,66 @@ def _thin_by_bucket(board: chess.Board, denom: int, salt: int) -> bool:
 # NO-TB filter
 # =============================================================================
 
-def filter_notb_kr_vs_krp(board: chess.Board) -> bool:
-    wk = board.king(chess.WHITE)
-    bk = board.king(chess.BLACK)
-
-    try:
-        bp = next(iter(board.pieces(chess.PAWN, chess.BLACK)))
-        wr = next(iter(board.pieces(chess.ROOK, chess.WHITE)))
-        br = next(iter(board.pieces(chess.ROOK, chess.BLACK)))
-    except StopIteration:
-        return False
-
-    pf, pr = chess.square_file(bp), chess.square_rank(bp)
+@lru_cache(maxsize=1 << 20)
+def filter_notb_squares_kr_vs_krp(wk: int, bk: int, bp: int) -> bool:
+    """
+    Geometric part of filter_notb_kr_vs_krp, on square indices only.
+    """
+    pf, pr = bp & 7, bp >> 3
 
     # Canonical pawn (mirror duplicates) + focus ranks.
     if pf < _CANON_PAWN_FILE_MIN or pf > _CANON_PAWN_FILE_MAX:
         return False
-    if pr not in _ALLOWED_PAWN_RANKS:
+    if not (1 << pr) & _ALLOWED_PAWN_RANK_BITS:
         return False
 
     # Combat zone.
-    if chess.square_distance(wk, bp) > 4:
+    if CHEB[(wk << 6) | bp] > 4:
         return False
-    if chess.square_distance(bk, bp) > 4:
+    if CHEB[(bk << 6) | bp] > 4:
+        return False
+
+    return True
+
+
+def filter_notb_placement_kr_vs_krp(wk: int, bk: int, pieces: Sequence[Tuple[bool, int, Tuple[int, ...]]]) -> bool:
+    """
+    filter_notb_squares_kr_vs_krp on a generator placement, before any Board is built.
+    pieces is in generation group order: white rook, black rook, black pawn.
+    """
+    _, _, (_, _, (bp,)) = pieces
+    return filter_notb_squares_kr_vs_krp(wk, bk, bp)
+
+
+def filter_notb_kr_vs_krp(board: chess.Board) -> bool:
+    wk = board.king(chess.WHITE)
+    bk = board.king(chess.BLACK)
+
+    bp_bb = board.pawns & board.occupied_co[chess.BLACK]
+    wr_bb = board.rooks & board.occupied_co[chess.WHITE]
+    br_bb = board.rooks & board.occupied_co[chess.BLACK]
+    if not bp_bb or not wr_bb or not br_bb:
         return False
+    bp = _lsb(bp_bb)
+    wr = _lsb(wr_bb)
+    br = _lsb(br_bb)
 
-    if board.is_check():
+    if not filter_notb_squares_kr_vs_krp(wk, bk, bp):
+        return False
+
+    if board.checkers_mask():
         return False
 
     # Remove immediate tactical simplifications: any capture from the root => reject.
-    for mv in board.legal_moves:
-        if board.is_capture(mv):
-            return False
+    if next(board.generate_legal_captures(), None) is not None:
+        return False
 
     # Require both king and rook options (otherwise too forced / dull).
     rook_moves = 0
     king_moves = 0
-    for mv in board.legal_moves:
-        pt = board.piece_at(mv.from_square).piece_type
+    piece_type_at = board.piece_type_at
+    for mv in board.generate_legal_moves():
+        pt = piece_type_at(mv.from_square)
         if pt == chess.ROOK:
             rook_moves += 1
         elif pt == chess.KING:
@@ -184,9 +214,9 @@ def filter_notb_kr_vs_krp(board: chess.Board) -> bool:
         return False
 
     # Avoid immediate adjacency tactics.
-    if chess.square_distance(br, wk) <= 1:
+    if CHEB[(br << 6) | wk] <= 1:
         return False
-    if chess.square_distance(wr, bk) <= 1:
+    if CHEB[(wr << 6) | bk] <= 1:
         return False
 
     return True
@@ -204,10 +234,23 @@ def filter_tb_kr_vs_krp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
     if wdl > 0:
         return False
 
-    legal_moves = list(board.legal_moves)
+    # Loss DTM window, checked before any move generation or probing.
+    if wdl < 0:
+        if dtm is None:
+            return False
+        a = abs(int(dtm))
+        if a < _MIN_ABS_DTM_LOSS or a > _MAX_ABS_DTM_LOSS:
+            return False
+
+    legal_moves = tb["legal_moves"]()
     if len(legal_moves) < 4:
         return False
 
+    # Moving-piece type tests against the side-to-move bitboards (no Piece objects).
+    own = board.occupied_co[board.turn]
+    rook_mask = board.rooks & own
+    king_mask = board.kings & own
+
     # ----------------------------
     # DRAW branch
     # ----------------------------
@@ -222,7 +265,7 @@ def filter_tb_kr_vs_krp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
         # so we need to examine all moves, but we can early-reject if exceeded.
         for mv in legal_moves:
             res = tb["probe_move"](mv)
-            m_wdl = int(res["wdl"])
+            m_wdl = int(res.wdl)
             if m_wdl > 0:
                 return False  # shouldn't happen
             if m_wdl == 0:
@@ -231,15 +274,15 @@ def filter_tb_kr_vs_krp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
                     return False
             else:
                 loss_exists = True
-                m_dtm = res.get("dtm", None)
+                m_dtm = res.dtm
                 if m_dtm is None:
                     return False
                 if abs(int(m_dtm)) <= _DRAW_QUICK_LOSS_MAX_ABS_DTM:
                     quick_loss = True
-                pt = board.piece_at(mv.from_square).piece_type
-                if pt == chess.ROOK:
+                from_bb = chess.BB_SQUARES[mv.from_square]
+                if from_bb & rook_mask:
                     loss_rook += 1
-                elif pt == chess.KING:
+                elif from_bb & king_mask:
                     loss_king += 1
 
         if not loss_exists:
@@ -260,12 +303,6 @@ def filter_tb_kr_vs_krp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
     # LOSS branch
     # ----------------------------
     if wdl < 0:
-        if dtm is None:
-            return False
-        a = abs(int(dtm))
-        if a < _MIN_ABS_DTM_LOSS or a > _MAX_ABS_DTM_LOSS:
-            return False
-
         dtms: list[int] = []
         best_dtm = None
         best_count = 0
@@ -278,10 +315,10 @@ def filter_tb_kr_vs_krp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
 
         for mv in legal_moves:
             res = tb["probe_move"](mv)
-            m_wdl = int(res["wdl"])
+            m_wdl = int(res.wdl)
             if m_wdl >= 0:
                 return False  # if any draw exists, root would be draw
-            m_dtm = res.get("dtm", None)
+            m_dtm = res.dtm
             if m_dtm is None:
                 return False
             d = int(m_dtm)
@@ -320,10 +357,10 @@ def filter_tb_kr_vs_krp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
         for mv, d in zip(legal_moves, dtms):
             if (d - best_dtm) < _LOSS_BIG_BLUNDER_GAP_MIN:
                 continue
-            pt = board.piece_at(mv.from_square).piece_type
-            if pt == chess.ROOK:
+            from_bb = chess.BB_SQUARES[mv.from_square]
+            if from_bb & rook_mask:
                 big_blunder_rook = True
-            elif pt == chess.KING:
+            elif from_bb & king_mask:
                 big_blunder_king = True
             if big_blunder_rook and big_blunder_king:
                 break
@@ -332,10 +369,10 @@ def filter_tb_kr_vs_krp(board: chess.Board, tb: Mapping[str, Any]) -> bool:
             return False
 
         # Avoid ultra-forced patterns: if best defense is rook move and king has almost no options.
-        if board.piece_at(best_mv.from_square).piece_type == chess.ROOK:
+        if chess.BB_SQUARES[best_mv.from_square] & rook_mask:
             king_moves = 0
             for mv in legal_moves:
-                if board.piece_at(mv.from_square).piece_type == chess.KING:
+                if chess.BB_SQUARES[mv.from_square] & king_mask:
                     king_moves += 1
             if king_moves <= 1:
                 return False
@@ -2,71 +2,99 @@
 
 from __future__ import annotations
 
-from typing import Any, Mapping
+from functools import lru_cache
+from typing import Any, Mapping, Sequence, Tuple
 
 import chess
 
-from helpers import mask_files, mask_ranks
+from helpers import CHEB, _lsb, mask_files, mask_ranks
 
 
-def filter_notb_krp_vs_kr(board: chess.Board) -> bool:
-    """
-    KRP (White) vs KR (Black).
-    CORRECTED VERSION.
-    """
-    wk = board.king(chess.WHITE)
-    bk = board.king(chess.BLACK)
-
-    # Safe extraction
-    try:
-        wp = next(iter(board.pieces(chess.PAWN, chess.WHITE)))
-        wr = next(iter(board.pieces(chess.ROOK, chess.WHITE)))
-        br = next(iter(board.pieces(chess.ROOK, chess.BLACK)))
-    except StopIteration:
-        return False
+# Pawn decision zone: files b-g, ranks index 4/5 (human 5/6).
+_PAWN_ZONE_MASK = mask_files(1, 6) & mask_ranks([4, 5])
 
-    pf, pr = chess.square_file(wp), chess.square_rank(wp)
 
+@lru_cache(maxsize=1 << 20)
+def filter_notb_squares_krp_vs_kr(wk: int, wp: int) -> bool:
+    """
+    Geometric part of filter_notb_krp_vs_kr, on square indices only.
+    """
     # 1. Pawn: files b-g, ranks index 4/5 (human 5/6).
     # This is the decision zone (Lucena vs Philidor).
-    if pf < 1 or pf > 6:
-        return False
-    if pr not in (4, 5):
-        return False
-
-    # 2. Safety: no check to the white king (essential for evaluation).
-    if board.is_check():
+    if not _PAWN_ZONE_MASK & (1 << wp):
         return False
 
     # 3. White king: must support the pawn (distance <= 2).
     # If it is farther, it is not useful.
-    wkf, wkr = chess.square_file(wk), chess.square_rank(wk)
-    if max(abs(wkf - pf), abs(wkr - pr)) > 2:
+    if CHEB[(wk << 6) | wp] > 2:
         return False
 
     # (NOTE: The black king distance constraint was removed
     # to allow "cut off" kings far away).
 
+    return True
+
+
+def filter_notb_placement_krp_vs_kr(wk: int, bk: int, pieces: Sequence[Tuple[bool, int, Tuple[int, ...]]]) -> bool:
+    """
+    filter_notb_squares_krp_vs_kr on a generator placement, before any Board is built.
+    pieces is in generation group order: white rook, white pawn, black rook.
+    """
+    _, (_, _, (wp,)), _ = pieces
+    return filter_notb_squares_krp_vs_kr(wk, wp)
+
+
+def filter_notb_krp_vs_kr(board: chess.Board) -> bool:
+    """
+    KRP (White) vs KR (Black).
+    CORRECTED VERSION.
+    """
+    white = board.occupied_co[chess.WHITE]
+    black = board.occupied_co[chess.BLACK]
+    wp_bb = board.pawns & white
+    wr_bb = board.rooks & white
+    br_bb = board.rooks & black
+
+    # Safe extraction
+    if not wp_bb or not wr_bb or not br_bb:
+        return False
+    wk_bb = board.kings & white
+    assert wk_bb
+    wk = _lsb(wk_bb)
+    wp = _lsb(wp_bb)
+    wr = _lsb(wr_bb)
+    br = _lsb(br_bb)
+
+    # 1. + 3. Pawn zone and white king support (pure geometry, checked first).
+    if not filter_notb_squares_krp_vs_kr(wk, wp):
+        return False
+
+    # 2. Safety: no check to the white king (essential for evaluation).
+    if board.checkers_mask():
+        return False
+
     # 4. Activity: no immediate capture (tactical cleanup).
-    for mv in board.legal_moves:
-        if board.is_capture(mv):
+    # Pseudo-legal attack test first; legality is only checked when a black piece is attacked.
+    white_attacks = (
+        chess.BB_KING_ATTACKS[wk]
+        | board.attacks_mask(wr)
+        | chess.BB_PAWN_ATTACKS[chess.WHITE][wp]
+    )
+    if white_attacks & black or board.ep_square is not None:
+        if next(board.generate_legal_captures(), None) is not None:
             return False
 
     # 5. Black rook: major correction here.
     # It must not attack the king (check) or the rook (exchange),
     # BUT it must be able to attack the pawn (foundation of defense).
-    br_attacks = board.attacks(br)
-    for sq in (wk, wr):  # <-- wp was removed from this list!
-        if (br_attacks >> sq) & 1:
-            return False
+    # (wp is deliberately not part of this mask.)
+    if board.attacks_mask(br) & (chess.BB_SQUARES[wk] | chess.BB_SQUARES[wr]):
+        return False
 
     # 6. Pawn protection.
     # If the pawn is attacked (by king or rook), it must be defended.
-    attackers = board.attackers(chess.BLACK, wp)
-    if attackers:
-        defenders = board.attackers(chess.WHITE, wp)
-        if not defenders:
-            return False
+    if board.is_attacked_by(chess.BLACK, wp) and not board.is_attacked_by(chess.WHITE, wp):
+        return False
 
     return True
 
@@ -76,21 +104,22 @@ def filter_tb_krp_vs_kr(board: chess.Board, tb: Mapping[str, Any]) -> bool:
     KRP vs KR TB filter.
     Selects 'Precision Wins' or 'False Wins'.
     """
-    dtm = tb["dtm"]
-    if dtm is not None and abs(dtm) < 11:
-        return False
-
     wdl = tb["wdl"]
 
     # Reject losses: too rare or caused by blunders.
     if wdl < 0:
         return False
 
+    dtm = tb["dtm"]
+    if dtm is not None and abs(dtm) < 11:
+        return False
+
     # --- Case 1: Win (seek precision / Lucena) ---
     if wdl > 0:
+        probe_move_wdl = tb["probe_move_wdl"]
         winning = 0
-        for move in board.legal_moves:
-            if tb["probe_move"](move)["wdl"] == 1:
+        for move in board.generate_legal_moves():
+            if probe_move_wdl(move) == 1:
                 winning += 1
                 if winning > 1:
                     return False  # Too easy if multiple winning lines exist.
@@ -98,14 +127,19 @@ def filter_tb_krp_vs_kr(board: chess.Board, tb: Mapping[str, Any]) -> bool:
 
     # --- Case 2: Draw (seek the illusion of a win) ---
     if wdl == 0:
-        wp = next(iter(board.pieces(chess.PAWN, chess.WHITE)))
-        wk = board.king(chess.WHITE)
-        bk = board.king(chess.BLACK)
-
-        pr = chess.square_rank(wp)
-        pf = chess.square_file(wp)
-        wkr = chess.square_rank(wk)
-        bkf = chess.square_file(bk)
+        white = board.occupied_co[chess.WHITE]
+        wp_bb = board.pawns & white
+        wk_bb = board.kings & white
+        bk_bb = board.kings & board.occupied_co[chess.BLACK]
+        assert wp_bb and wk_bb and bk_bb
+        wp = _lsb(wp_bb)
+        wk = _lsb(wk_bb)
+        bk = _lsb(bk_bb)
+
+        pr = wp >> 3
+        pf = wp & 7
+        wkr = wk >> 3
+        bkf = bk & 7
 
         # 1. Activity illusion: the white king is in front of or next to the pawn.
         # If it is behind (wkr < pr), it is passive and the draw is obvious.
@@ -131,7 +165,7 @@ def gen_hints_krp_vs_kr() -> Mapping[str, Any]:
     """
     return {
         "piece_masks": {
-            (True, chess.PAWN): mask_files(1, 6) & mask_ranks([4, 5]),
+            (True, chess.PAWN): _PAWN_ZONE_MASK,
         },
         "wk_to_pawn_cheb": (0, 2),
     }
@@ -0,0 +1,137 @@
+
+import contextlib
+import io
+import multiprocessing
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import chess
+
+import generate_positions as gp
+
+
+class CountingTablebase:
+    # Returns a new DTM on every probe, so a cached result is told apart from a fresh probe.
+    def __init__(self):
+        self.calls = 0
+
+    def probe_dtm(self, board):
+        self.calls += 1
+        return self.calls
+
+    def close(self):
+        pass
+
+
+class MirrorSymmetricTablebase:
+    # Deterministic DTM that is the same for a position and its left-right mirror,
+    # like a real tablebase (the probe cache relies on it).
+    def probe_dtm(self, board):
+        h = 1 if board.turn == chess.WHITE else 2
+        for sq, piece in board.piece_map().items():
+            f = chess.square_file(sq)
+            h = h * 31 + chess.square_rank(sq) * 8 + min(f, 7 - f) + piece.piece_type * 64 + piece.color * 512
+        dtm = 1 + h % 29
+        return dtm if h % 3 else -dtm
+
+    def close(self):
+        pass
+
+
+def test_probe_cache_mirror():
+    # A position and its mirror share one cache entry: the second probe reuses the first DTM.
+    gp._PROBE_CACHE.clear()
+    tb = CountingTablebase()
+    board = chess.Board("4k3/8/8/8/8/8/1P6/1K6 w - - 0 1")
+    mirrored = board.transform(chess.flip_horizontal)
+    assert board.board_fen() != mirrored.board_fen()
+
+    first = gp.probe_dtm_only_white_pov(tb, board)
+    assert first == (1, 1)
+    assert gp.probe_dtm_only_white_pov(tb, mirrored) == first
+    assert tb.calls == 1
+
+
+def test_probe_cache_skips_ep():
+    # Positions with an en passant square are always probed, never cached.
+    gp._PROBE_CACHE.clear()
+    tb = CountingTablebase()
+    board = chess.Board("4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1")
+    assert board.ep_square is not None
+    assert gp._probe_cache_key(board) is None
+
+    assert gp.probe_dtm_only_white_pov(tb, board) == (1, 1)
+    assert gp.probe_dtm_only_white_pov(tb, board) == (1, 2)
+    assert tb.calls == 2
+    assert not gp._PROBE_CACHE
+
+
+def test_tb_probe_reset():
+    # reset() must drop the per-move results and legal moves of the previous root.
+    gp._PROBE_CACHE.clear()
+    tb = CountingTablebase()
+    probe = gp.TBProbe(tb)
+    move = chess.Move.from_uci("a1b1")
+
+    root1 = chess.Board("7k/8/8/8/8/8/4P3/K7 w - - 0 1")
+    probe.reset(root1, 1, 1)
+    first = probe.probe_move(move)
+    assert probe.probe_move(move) is first
+    assert len(probe.probe_wdls()) == root1.legal_moves.count()
+
+    root2 = chess.Board("7k/8/8/8/8/8/3P4/K7 w - - 0 1")
+    info = probe.reset(root2, -1, -3)
+    assert info["wdl"] == -1 and info["dtm"] == -3
+    second = probe.probe_move(move)
+    assert second is not first
+    assert probe.legal_moves() == list(root2.legal_moves)
+    assert len(probe.probe_wdls()) == root2.legal_moves.count()
+
+
+def _run_main(workdir, w, b, jobs):
+    argv = sys.argv
+    cwd = os.getcwd()
+    sys.argv = ["generate_positions.py", "--w", w, "--b", b, "--jobs", str(jobs)]
+    os.chdir(workdir)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            gp.main()
+    finally:
+        os.chdir(cwd)
+        sys.argv = argv
+    return (Path(workdir) / "data" / f"{w}_{b}.txt").read_bytes()
+
+
+def test_jobs_same_output():
+    # A parallel run writes exactly the file of an in-process run.
+    # The stub tablebase reaches the workers through fork.
+    if "fork" not in multiprocessing.get_all_start_methods():
+        print("fork start method unavailable: skipped")
+        return
+    multiprocessing.set_start_method("fork", force=True)
+
+    find_dirs = gp.find_gaviota_dirs
+    open_tb = gp.open_tablebase_native_fixed
+    gp.find_gaviota_dirs = lambda root: []
+    gp.open_tablebase_native_fixed = lambda dirs: MirrorSymmetricTablebase()
+    try:
+        for w, b in (("K", "KP"), ("KP", "K")):
+            with tempfile.TemporaryDirectory() as d1, tempfile.TemporaryDirectory() as d3:
+                gp._PROBE_CACHE.clear()
+                sequential = _run_main(d1, w, b, 1)
+                gp._PROBE_CACHE.clear()
+                parallel = _run_main(d3, w, b, 3)
+                assert sequential == parallel, f"{w}_{b}: --jobs 1 and --jobs 3 differ"
+    finally:
+        gp.find_gaviota_dirs = find_dirs
+        gp.open_tablebase_native_fixed = open_tb
+
+
+if __name__ == "__main__":
+    test_probe_cache_mirror()
+    test_probe_cache_skips_ep()
+    test_tb_probe_reset()
+    test_jobs_same_output()
+    print("ok")